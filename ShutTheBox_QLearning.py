@@ -1,130 +1,147 @@
-import csv
-from statistics import mean
-from statistics import pstdev
-from itertools import combinations
+from game import Game, getRules, tilesToMask
+from stats import RunningStats
+from tablefile import qtableArrays, saveQTable
+from results import ResultWriter
+from evaluate import exactEvaluation, policyTables
+from metrics import Metrics
 import random
+import time
 
 random.seed()
 
 
+def decayingEpsilon(episode):
+    """
+    Exploration rate of a training episode: starts at 0.5 and drops by 0.005 every 1000 episodes down to 0
+    """
+    return max(0.5 - 0.005*(episode//1000), 0)
+
+
 class diceRoll(object):
-    def __init__(self):
+    def __init__(self, state=None, rules=None):
+        rules = rules if rules is not None else getRules()
         self.qvalue = 0
         self.rolls = {}
-        self.initRolls()
-
-    def initRolls(self):
-        tiles = [1, 2, 3, 4, 5, 6, 7, 8, 9]
-        comboStates = []
-        for i in range(1, 13):
-            roll = i
-            choices = {}
-            for j in range(1, 10):
-                for combo in combinations(tiles, j):
-                    if sum(combo) == roll:
-                        choices.update({combo: 0})
-                    choices.update({(): 0})
-            if len(choices) > 0:
-                comboStates.append({roll: choices})
-
-        for state in comboStates:
-            self.rolls.update(state)
+        # Cached maxima, kept up to date by setValue:
+        #   bestChoice[roll] = (value, combo) of the best combo for a roll
+        #   bestRoll = (value, roll, combo) of the best combo over all rolls
+        self.bestChoice = {}
+        self.bestRoll = (0, None, None)
+        self.initRolls(state if state is not None else rules.table.maskTiles[rules.table.fullMask], rules)
+
+    def initRolls(self, state, rules):
+        # Only the combos that can be played from state get an entry, read from the shared move table
+        table = rules.table
+        mask = tilesToMask(state)
+        for roll in range(1, rules.maxRoll+1):
+            self.rolls[roll] = {table.maskTiles[combo]: 0 for combo in table.legalCombos(mask, roll)}
+        for roll in self.rolls:
+            self.bestChoice[roll] = self.scanRoll(roll)
+        self.bestRoll = self.scanRolls()
+
+    def scanRoll(self, roll):
+        bestValue, bestCombo = None, None
+        for combo, value in self.rolls[roll].items():
+            if bestValue is None or value >= bestValue:
+                bestValue, bestCombo = value, combo
+        return (bestValue, bestCombo)
+
+    def scanRolls(self):
+        # With no playable combo at all, the best value is 0
+        best = (0, None, None)
+        for roll, (value, combo) in self.bestChoice.items():
+            if value is not None and value >= best[0]:
+                best = (value, roll, combo)
+        return best
+
+    def setValue(self, roll, combo, value):
+        """
+        Sets the Q-value of a combo for a roll and updates the cached maxima. Rescans only happen when the
+        current best entry decreases: over the roll's combos, and over the per-roll maxima.
+        """
+        self.rolls[roll][combo] = value
+        bestValue, bestCombo = self.bestChoice[roll]
+        if bestValue is None or value >= bestValue:
+            self.bestChoice[roll] = (value, combo)
+        elif combo == bestCombo:
+            self.bestChoice[roll] = self.scanRoll(roll)
+        value, combo = self.bestChoice[roll]
+        if value >= self.bestRoll[0]:
+            self.bestRoll = (value, roll, combo)
+        elif roll == self.bestRoll[1]:
+            self.bestRoll = self.scanRolls()
+
+
+class lazyRollTable(dict):
+    """
+    Maps a tuple of current tiles to [1-dice, 2-dice, ...] diceRoll entries, one per number of dice of the
+    rules, creating them on first use
+    """
+    def __init__(self, rules):
+        dict.__init__(self)
+        self.rules = rules
+
+    def __missing__(self, state):
+        entry = [diceRoll(state, self.rules) for _ in range(self.rules.numDice)]
+        self[state] = entry
+        return entry
 
 
 class qtable(object):
-    def __init__(self):
-        self.rollTable = {}
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else getRules()
+        self.rollTable = lazyRollTable(self.rules)
         self.eta = 0.2
         self.gamma = 0.9
+        self.updates = 0
         self.initTables()
 
     def initTables(self):
-        tiles = [1, 2, 3, 4, 5, 6, 7, 8, 9]
-
-        rollStates = []
-
-        for i in range(0, 10):
-            combos = combinations(tiles, i)
-            for combo in combos:
-                rollStates.append(combo)
-
         # key = Tuple of current tiles
-        # value = [1-dice, 2-dice]
-        for state in rollStates:
-            dice1 = diceRoll()
-            dice2 = diceRoll()
-            self.rollTable.update({state: [dice1, dice2]})
-
+        # value = [1-dice, 2-dice, ...]
         # preset final state to high values so it will be preferred during updates
-        # no rolls will actually be done once final state is reached
-        self.rollTable[()][0].qvalue = 100
-        self.rollTable[()][1].qvalue = 100
-        for i in range(1, 7):
-            for key in self.rollTable[()][0].rolls[i]:
-                self.rollTable[()][0].rolls[i][key] = 100
-
-        for i in range(2, 13):
-            for key in self.rollTable[()][1].rolls[i]:
-                self.rollTable[()][1].rolls[i][key] = 100
+        # no rolls will actually be done once final state is reached, so it has no combo entries
+        # and its best combo value is preset as well
+        for dice in self.rollTable[()]:
+            dice.qvalue = 100
+            dice.bestRoll = (100, None, None)
+
+    def bestDice(self, state):
+        """
+        Index (dice-1) of the number of dice with the highest Q-value, the most dice among equal values
+        """
+        entry = self.rollTable[state]
+        maxAction = len(entry) - 1
+        for action in range(len(entry) - 2, -1, -1):
+            if entry[action].qvalue > entry[maxAction].qvalue:
+                maxAction = action
+        return maxAction
 
     def updateRollTable(self, state1, dice, roll, rollChoice, state2, reward):
+        self.updates += 1
 
-        maxAction = 0
-        if self.rollTable[state2][0].qvalue > self.rollTable[state2][1].qvalue:
-            maxAction = 0
-        else:
-            maxAction = 1
-
-        maxRoll = 0
-        maxRollChoice = ()
-        for keys in self.rollTable[state2][maxAction].rolls.keys():
-            bestChoice = 0
-            for key in self.rollTable[state2][maxAction].rolls[keys].keys():
-                if self.rollTable[state2][maxAction].rolls[keys][key] >= bestChoice:
-                    bestChoice = self.rollTable[state2][maxAction].rolls[keys][key]
-                    maxRollChoice = key
-                    maxRoll = keys
+        maxAction = self.bestDice(state2)
+
+        # Best (roll, combo) value of the next state comes from the cached maxima
+        maxRollValue = self.rollTable[state2][maxAction].bestRoll[0]
 
         # Update Q-values based on update equation
-        if dice == 1:
-            self.rollTable[state1][0].qvalue = self.rollTable[state1][0].qvalue + self.eta * (
-                    reward + self.gamma * self.rollTable[state2][maxAction].qvalue - self.rollTable[state1][0].qvalue)
-
-            if rollChoice is not -1:
-                self.rollTable[state1][0].rolls[roll][rollChoice] = self.rollTable[state1][0].rolls[roll][
-                                                                        rollChoice] + self.eta * (
-                                                                            reward + self.gamma *
-                                                                            self.rollTable[state2][maxAction].rolls[
-                                                                                maxRoll][maxRollChoice] -
-                                                                            self.rollTable[state1][0].rolls[roll][
-                                                                                rollChoice])
-
-        if dice == 2:
-            self.rollTable[state1][1].qvalue = self.rollTable[state1][1].qvalue + self.eta * (
-                    reward + self.gamma * self.rollTable[state2][maxAction].qvalue - self.rollTable[state1][1].qvalue)
-            if rollChoice is not -1:
-                self.rollTable[state1][1].rolls[roll][rollChoice] = self.rollTable[state1][1].rolls[roll][
-                                                                        rollChoice] + self.eta * (
-                                                                            reward + self.gamma *
-                                                                            self.rollTable[state2][maxAction].rolls[
-                                                                                maxRoll][maxRollChoice] -
-                                                                            self.rollTable[state1][1].rolls[roll][
-                                                                                rollChoice])
+        if 1 <= dice <= self.rules.numDice:
+            current = self.rollTable[state1][dice - 1]
+            current.qvalue = current.qvalue + self.eta * (
+                    reward + self.gamma * self.rollTable[state2][maxAction].qvalue - current.qvalue)
+
+            if rollChoice != -1:
+                value = current.rolls[roll][rollChoice]
+                current.setValue(roll, rollChoice, value + self.eta * (reward + self.gamma * maxRollValue - value))
 
     # return action to take based on epsilon greedy algorithm
     def greedyDice(self, state, epsilon):
         percent = (1 - epsilon) * 100
         if random.randint(1, 100) > percent:
-            choices = [1, 2]
-            return choices[random.randint(0, 1)]
+            return random.randint(0, self.rules.numDice - 1) + 1
         else:
-            maxAction = 0
-            if self.rollTable[state][0].qvalue > self.rollTable[state][1].qvalue:
-                maxAction = 1
-            else:
-                maxAction = 2
-
-            return maxAction
+            return self.bestDice(state) + 1
 
     def greedyCombo(self, roll, dice, state, choices, epsilon):
         percent = (1 - epsilon) * 100
@@ -134,176 +151,167 @@ class qtable(object):
             return choices[index]
 
         # else:
-        maxVal = self.rollTable[state][dice - 1].rolls[roll][choices[0]]
-        for choice in choices:
-            if self.rollTable[state][dice - 1].rolls[roll][choice] >= maxVal:
-                maxVal = self.rollTable[state][dice - 1].rolls[roll][choice]
-                maxChoice = choice
-
-        return maxChoice
-
-
-if __name__ == "__main__":
-    table = qtable()
-
-    """******************************************************************************************"""
-    print("Running Training Episodes ", end='')
-
-    eps = 0.5
-    trainingRewards = []
-
-    for N in range(100000):
-        gameState = [1, 2, 3, 4, 5, 6, 7, 8, 9]
-        gameOver = False
-
-        # decay epsilon
-        if N != 0:
-            if N % 1000 == 0:
-                eps -= 0.005
-        if eps < 0:
-            eps = 0
-
-        rewardSum = 0
-        while not gameOver:
-            reward = 0
-            state1 = tuple(gameState)
-
-            if any(item in state1 for item in [7, 8, 9]):
-                dice = 2
-            else:
-                dice = table.greedyDice(state1, eps)
-
-            # Roll the dice
-            roll = 0
-            if dice == 1:
-                roll = random.randint(1, 6)
-            else:
-                roll_1 = random.randint(1, 6)
-                roll_2 = random.randint(1, 6)
-                roll = roll_1 + roll_2
-
-            choice = ()
-            valid = []
-            for i in range(len(state1) + 1):
-                for combo in combinations(state1, i):
-                    if sum(combo) == roll:
-                        valid.append(combo)
-
-            if len(valid) == 0:
-                # table.updateRollTable(state1, dice, roll, choice, state1, reward)
-                gameOver = True
-                break
-
-            choice = table.greedyCombo(roll, dice, state1, valid, eps)
-
-            for item in choice:
-                gameState.remove(item)
-                reward += item
-                rewardSum += item
-
-            if len(gameState) == 0:
-                reward += 100
-                rewardSum += 100
-                gameOver = True
-
-            table.updateRollTable(state1, dice, roll, choice, tuple(gameState), reward)
-
-        trainingRewards.append(rewardSum)
-
-        if N % 5000 == 0:
-            print(". ", end='')
-
-    print("\n\nTraining-Average: " + str(mean(trainingRewards)))
-    print("Training-Standard-Deviation: " + str(pstdev(trainingRewards)))
-    winCount = 0
-    for reward in trainingRewards:
-        if reward == 145:
-            winCount += 1
-    winPercent = (winCount / 100000) * 100
-    print("Training-Wins: %d out of 100,000 games" % winCount)
-    print("Training-Win-Percentage: %f" % winPercent)
-
+        bestValue, bestCombo = self.rollTable[state][dice - 1].bestChoice[roll]
+        return bestCombo
+
+
+def playEpisode(table, eps, learn=True):
+    """
+    Plays one game from the full board with an epsilon-greedy policy over table
+
+    Parameters:
+        table (qtable): Q-table to choose moves from
+        eps (float): Exploration rate
+        learn (bool): Whether to update table after every move
+
+    Returns:
+        tuple: Total reward of the game (score removed by the tiles shut plus 100 for a win), whether the game
+               was won and the final game
+    """
+    game = Game(2, rules=table.rules)
+    rewardSum = 0
+    while True:
+        state1 = tuple(game.tiles)
+
+        # choose dice unless a tile above the rules' threshold is still up
+        options = game.diceOptions()
+        if len(options) == 1:
+            dice = options[0]
+        else:
+            dice = table.greedyDice(state1, eps)
+
+        # Roll the dice
+        roll = game.rollDice(dice)
+
+        valid = game.validCombos(roll)
+        if len(valid) == 0:
+            return rewardSum, False, game
+
+        choice = table.greedyCombo(roll, dice, state1, valid, eps)
+        score = game.getScore()
+        game.playCombo(choice)
+        reward = score - game.getScore()
+
+        won = game.getScore() == 0
+        if won:
+            reward += 100
+        rewardSum += reward
+
+        if learn:
+            table.updateRollTable(state1, dice, roll, choice, tuple(game.tiles), reward)
+        if won:
+            return rewardSum, True, game
+
+
+class QLearner(object):
+    """
+    Training and evaluation of a qtable. Both run as generators of RunningStats, so a caller can watch the
+    running mean, standard deviation and win rate, and stop early (e.g. once the win rate converges)
+    by breaking out of the loop. Memory stays constant in the number of episodes.
+    """
+    def __init__(self, table=None):
+        self.table = table if table is not None else qtable()
+        # Final game of the last episode played
+        self.lastGame = None
+        self.trainEpisodes = 0
+        self.trainSeconds = 0.0
+
+    def train(self, episodes, eta=0.2, gamma=0.9, eps_schedule=decayingEpsilon, reportEvery=1):
+        """
+        Runs episodes training games, with exploration rate eps_schedule(episode)
+
+        Yields:
+            RunningStats: Statistics of the episodes so far, every reportEvery episodes and after the last one
+        """
+        self.table.eta = eta
+        self.table.gamma = gamma
+        return self.__run__(episodes, eps_schedule, True, reportEvery)
+
+    def evaluate(self, episodes, reportEvery=1):
+        """
+        Runs episodes greedy games without learning
+
+        Yields:
+            RunningStats: Statistics of the episodes so far, every reportEvery episodes and after the last one
+        """
+        return self.__run__(episodes, lambda episode: 0, False, reportEvery)
+
+    def report(self):
+        """
+        Returns:
+            Metrics: Training episodes, Q-table updates and the time spent training (excluding the callers' loops)
+        """
+        return Metrics({"trainEpisodes": self.trainEpisodes, "updates": self.table.updates, "trainSeconds": self.trainSeconds})
+
+    def __run__(self, episodes, eps_schedule, learn, reportEvery):
+        stats = RunningStats()
+        start = time.perf_counter()
+        for N in range(episodes):
+            rewardSum, won, self.lastGame = playEpisode(self.table, eps_schedule(N), learn)
+            stats.add(rewardSum, won)
+            if learn:
+                self.trainEpisodes += 1
+            if (N+1) % reportEvery == 0 or N+1 == episodes:
+                if learn:
+                    self.trainSeconds += time.perf_counter() - start
+                yield stats
+                start = time.perf_counter()
+
+
+def runEpisodes(name, episodes, learner, runs, dotEvery, out):
+    """
+    Prints a dot every dotEvery episodes and the final statistics of runs, and appends the final
+    board and time of every episode to the results file of out
+
+    Returns:
+        tuple: RunningStats of all the episodes and the rewards of every 1000th episode
+    """
+    print("Running {} Episodes ".format(name), end='')
     storedRewards = []
-    for i in range(len(trainingRewards)):
-        if i % 1000 == 0:
-            storedRewards.append(trainingRewards[i])
-    print("Rewards at every 100 runs: " + str(storedRewards) + "\n")
-    """******************************************************************************************"""
-
-    """******************************************************************************************"""
-    realRewards = []
-    print("Running Test Episodes ", end='')
-
-    eps = 0
-
-    for N in range(10000):
-        gameState = [1, 2, 3, 4, 5, 6, 7, 8, 9]
-        gameOver = False
-
-        rewardSum = 0
-        while not gameOver:
-            reward = 0
-            state1 = tuple(gameState)
-
-            # choose dice unless 7, 8, or 9 tiles are still up
-            if any(item in state1 for item in [7, 8, 9]):
-                dice = 2
-            else:
-                dice = table.greedyDice(state1, eps)
-
-            roll = 0
-            if dice == 1:
-                roll = random.randint(1, 6)
-            else:
-                roll_1 = random.randint(1, 6)
-                roll_2 = random.randint(1, 6)
-                roll = roll_1 + roll_2
-
-            choice = ()
-            valid = []
-            for i in range(len(state1) + 1):
-                for combo in combinations(state1, i):
-                    if sum(combo) == roll:
-                        valid.append(combo)
-
-            if len(valid) == 0:
-                gameOver = True
-                break
-
-            choice = table.greedyCombo(roll, dice, state1, valid, eps)
-
-            for item in choice:
-                gameState.remove(item)
-                reward += item
-                rewardSum += item
-
-            if len(gameState) == 0:
-                reward += 100
-                rewardSum += 100
-                gameOver = True
-
-        realRewards.append(rewardSum)
-
-        if N % 500 == 0:
+    stats = RunningStats()
+    start = time.perf_counter()
+    for stats in runs:
+        N = stats.count - 1
+        end = time.perf_counter()
+        out.write(learner.lastGame.getScore(), learner.lastGame.tiles, seconds=end - start)
+        start = end
+        if N % dotEvery == 0:
             print(". ", end='')
+        if N % 1000 == 0:
+            storedRewards.append(stats.last)
+
+    print("\n\n{}-Average: {}".format(name, stats.mean))
+    print("{}-Standard-Deviation: {}".format(name, stats.stddev))
+    print("{}-Wins: {} out of {:,} games".format(name, stats.wins, episodes))
+    print("{}-Win-Percentage: {:f}".format(name, stats.winRate*100))
+    return stats, storedRewards
+
+
+def main(trainingEpisodes=100000, testEpisodes=10000, tablePath='QTable.bin', resultsPath='QLearningResults.bin', rules=None,
+         seed=None):
+    # Training and test episodes draw from the random module, so a seed replays the whole run
+    if seed is not None:
+        random.seed(seed)
+    learner = QLearner(qtable(rules))
+
+    with ResultWriter(resultsPath, "qlearn-train") as out:
+        stats, storedRewards = runEpisodes("Training", trainingEpisodes, learner, learner.train(trainingEpisodes), 5000, out)
+    print("Rewards at every 1000 runs: " + str(storedRewards) + "\n")
+
+    # Trained table, loadable with tablefile.TablePolicy
+    qdice, qcombo = qtableArrays(learner.table)
+    saveQTable(tablePath, qdice, qcombo, eta=learner.table.eta, gamma=learner.table.gamma, episodes=trainingEpisodes,
+               rules=learner.table.rules)
+
+    with ResultWriter(resultsPath, "qlearn-test") as out:
+        runEpisodes("Test", testEpisodes, learner, learner.evaluate(testEpisodes), 500, out)
+    # Final scores of the test episodes, as the results of the other experiments (runEpisodes' stats are rewards)
+    testStats = out.stats
+    # Final score distribution of the greedy table without sampling (scores, not rewards)
+    print("Test-Exact: {}".format(exactEvaluation(*policyTables("table", learner.table.rules, tablePath))))
+    print("Training: {}".format(learner.report()))
+    return learner.report(), testStats
 
-    print("\n\nTest-Average: " + str(mean(realRewards)))
-    print("Test-Standard-Deviation: " + str(pstdev(realRewards)))
-    winCount = 0
-    for reward in realRewards:
-        if reward == 145:
-            winCount += 1
-    winPercent = (winCount / 10000) * 100
-    print("Test-Wins: %d out of 10,000 games" % winCount)
-    print("Test-Win-Percentage: %f" % winPercent)
-    """******************************************************************************************"""
-
-    with open('TrainingRewards.csv', 'w', newline='') as csvfile:
-        rewardWriter = csv.writer(csvfile)
-        rewardWriter.writerow(trainingRewards)
-
-    with open('RealRewards.csv', 'w', newline='') as csvfile:
-        rewardWriter = csv.writer(csvfile)
-        rewardWriter.writerow(realRewards)
-        rewardWriter.writerow([mean(realRewards)])
-        rewardWriter.writerow([pstdev(realRewards)])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,555 @@
+from game import Game, addRulesArguments, rulesFromArguments
+from minimax import Minimax, TranspositionCache
+from solver import ExactSolver, Solution
+from tablefile import TablePolicy, saveQTable
+from stats import RunningStats
+from montecarlo import MonteCarlo
+from montecarlo_array import ArrayMonteCarlo, bytesPerNode
+import ShutTheBox_QLearning as qlearn
+import experiment
+from results import ResultWriter
+from metrics import Metrics
+from functools import partial
+from multiprocessing import Pool
+import qlearning_dense
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+def minimax_nodes(depths):
+    """
+    Nodes/second of the deepcopy and in-place Minimax searches, deciding every roll from the full 9-tile board
+    """
+    print("{:>5} {:>10} {:>10} {:>12} {:>14}".format("depth", "mode", "nodes", "seconds", "nodes/second"))
+    rates = {}
+    for depth in depths:
+        for inPlace in [False, True]:
+            game = Game(2, 9)
+            minimax = Minimax(2, depth, inPlace=inPlace)
+            start = time.perf_counter()
+            for roll in range(2, 13):
+                minimax.tileDecision(roll, game)
+            elapsed = time.perf_counter() - start
+            rates[inPlace] = minimax.nodesExpanded/elapsed
+            mode = "in-place" if inPlace else "deepcopy"
+            print("{:>5} {:>10} {:>10} {:>12.4f} {:>14.0f}".format(depth, mode, minimax.nodesExpanded, elapsed, rates[inPlace]))
+        print("{:>5} {:>10} {:>38.2f}x".format(depth, "speedup", rates[True]/rates[False]))
+
+def mcts_memory(rounds, c):
+    """
+    Memory per node of the object (MonteCarlo) and array (ArrayMonteCarlo) MCTS trees after simulating rounds from the full board
+    """
+    print("{:>8} {:>10} {:>12} {:>14} {:>12}".format("tree", "nodes", "bytes", "bytes/node", "seconds"))
+    for name in ["objects", "arrays"]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        if "objects" == name:
+            mc = MonteCarlo(Game(2, 9), rounds)
+            mc.simulate(rounds, c)
+            nodes = mc.treeSize()
+        else:
+            mc = ArrayMonteCarlo(Game(2, 9), rounds)
+            mc.simulate(rounds, c)
+            nodes = mc.treeSize()
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("{:>8} {:>10} {:>12} {:>14.1f} {:>12.4f}".format(name, nodes, size, size/nodes, elapsed))
+    print("Array tree fields take {} bytes per node".format(bytesPerNode()))
+
+def mcts_scaling(rounds, c, rollouts, workers_list, games, seed, game_rounds):
+    """
+    Rounds/second of MonteCarlo.simulate from the full board with root-parallel trees over 1..N worker processes,
+    and the mean score of games seed..seed+games-1 played by mcts_experiment with each worker count and game_rounds
+    rounds per move, so a speedup that costs decision quality shows up against 1 worker
+    """
+    print("{:>8} {:>10} {:>12} {:>14} {:>10} {:>12} {:>22} {:>8}".format(
+        "workers", "rounds", "seconds", "rounds/second", "speedup", "rounds/move", "mean score (95% CI)", "win %"))
+    base = None
+    for workers in workers_list:
+        mc = MonteCarlo(Game(2, 9), rounds, workers)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Warm up the process pool so its start-up is not timed
+            mc.simulate(workers, c, rollouts)
+            start = time.perf_counter()
+            mc.simulate(rounds, c, rollouts)
+            elapsed = time.perf_counter() - start
+        mc.close()
+        rate = rounds/elapsed
+        base = base or rate
+        stats = RunningStats()
+        for game_seed in range(seed, seed+games):
+            score = experiment.seeded_experiment(game_seed, experiment.mcts_experiment, c, game_rounds,
+                                                 game_rounds*10, rollouts, "objects", workers)[0]
+            stats.add(score, score == 0)
+        low, high = stats.meanInterval()
+        print("{:>8} {:>10} {:>12.4f} {:>14.0f} {:>9.2f}x {:>12} {:>8.2f} ({:>5.2f}, {:>5.2f}) {:>8.2f}".format(
+            workers, rounds, elapsed, rate, rate/base, game_rounds, stats.mean, low, high, stats.winRate*100))
+
+def qlearn_updates(episodes):
+    """
+    Updates/second and greedy choices/second of the dict Q-table over a training loop from the full board
+    """
+    table = qlearn.qtable()
+    updates = 0
+    updateTime = 0
+    choices = 0
+    choiceTime = 0
+    start = time.perf_counter()
+    for N in range(episodes):
+        eps = qlearn.decayingEpsilon(N)
+        game = Game(2, 9)
+        while True:
+            state1 = tuple(game.tiles)
+            options = game.diceOptions()
+            dice = options[0] if len(options) == 1 else table.greedyDice(state1, eps)
+            roll = game.rollDice(dice)
+            valid = game.validCombos(roll)
+            if len(valid) == 0:
+                break
+            choiceStart = time.perf_counter()
+            choice = table.greedyCombo(roll, dice, state1, valid, eps)
+            choiceTime += time.perf_counter() - choiceStart
+            choices += 1
+            game.playCombo(choice)
+            reward = sum(choice) + (100 if game.getScore() == 0 else 0)
+            updateStart = time.perf_counter()
+            table.updateRollTable(state1, dice, roll, choice, tuple(game.tiles), reward)
+            updateTime += time.perf_counter() - updateStart
+            updates += 1
+            if game.getScore() == 0:
+                break
+    elapsed = time.perf_counter() - start
+    print("Episodes: {} in {:.2f} seconds ({:.0f} episodes/second)".format(episodes, elapsed, episodes/elapsed))
+    print("Updates: {} ({:.0f} updates/second)".format(updates, updates/updateTime))
+    print("Greedy choices: {} ({:.0f} choices/second)".format(choices, choices/choiceTime))
+
+def qlearn_parallel(episodes, test_episodes, sync_every, workers_list, seed):
+    """
+    Final test win rate against wall-clock training time of the dense Q-table trained over 1..N worker processes
+    """
+    print("{:>8} {:>10} {:>12} {:>12} {:>14}".format("workers", "episodes", "seconds", "test mean", "test win %"))
+    for workers in workers_list:
+        start = time.perf_counter()
+        table, stats = qlearning_dense.trainParallel(episodes, workers, syncEvery=sync_every, seed=seed)
+        elapsed = time.perf_counter() - start
+        test = qlearning_dense.episodeStats(table.evaluate(test_episodes), table)
+        print("{:>8} {:>10} {:>12.4f} {:>12.3f} {:>14.3f}".format(workers, episodes, elapsed, test.mean, test.winRate*100))
+
+def init_chunks_worker():
+    experiment.init_minimax_worker(experiment.MINIMAX_CACHE_SIZE)
+    # Game logs of the one-game tasks would otherwise flood the terminal
+    sys.stdout = open(os.devnull, "w")
+
+def single_game(seed, algorithm):
+    if "minimax" == algorithm:
+        return experiment.seeded_experiment(seed, experiment.minimax_experiment, experiment.MINIMAX_MAXDEPTH, experiment.worker_cache)
+    return experiment.seeded_experiment(seed, experiment.mcts_experiment, 1, experiment.MCTS_ROUNDS, experiment.MCTS_ROUNDS*10, experiment.MCTS_ROLLOUTS)
+
+def experiment_chunks(algorithm, games, workers):
+    """
+    Games/second of an experiment.py multiproc run handing one game per task to the pool and recording every result,
+    against handing out chunks of games that come back as packed arrays
+    """
+    chunk_worker = experiment.minimax_chunk if "minimax" == algorithm else experiment.mcts_chunk
+    print("{:>10} {:>8} {:>12} {:>14} {:>10}".format("tasks", "games", "seconds", "games/second", "speedup"))
+    base = None
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ["per-game", "chunked"]:
+            with Pool(workers, initializer=init_chunks_worker) as pool, ResultWriter(os.path.join(directory, name), algorithm) as out:
+                metrics = Metrics()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    if "per-game" == name:
+                        for result in pool.imap(partial(single_game, algorithm=algorithm), range(games)):
+                            experiment.record_result(out, metrics, result)
+                    else:
+                        experiment.run_chunks(pool, chunk_worker, games, out, workers=workers)
+                    elapsed = time.perf_counter() - start
+            rate = games/elapsed
+            base = base or rate
+            print("{:>10} {:>8} {:>12.4f} {:>14.1f} {:>9.2f}x".format(name, games, elapsed, rate, rate/base))
+
+class DiceSequence:
+    """
+    Dice faces of one benchmark game, drawn from their own generator so every agent playing the game with
+    the same seed faces the same sequence of dice
+    """
+    def __init__(self, seed, faces=6):
+        self.rng = random.Random(seed)
+        self.faces = faces
+
+    def roll(self, dice):
+        return sum(self.rng.randint(1, self.faces) for _ in range(dice))
+
+class MctsAgent:
+    """
+    MonteCarlo behind the rollDecision/tileDecision interface, searching rounds per move as mcts_experiment does
+    """
+    def __init__(self, game, rounds, c=1):
+        self.mc = MonteCarlo(game, rounds*10)
+        self.rounds = rounds
+        self.c = c
+
+    def rollDecision(self, game):
+        self.mc.simulate(self.rounds, self.c)
+        return self.mc.rollDecision()
+
+    def tileDecision(self, roll, game):
+        tiles = self.mc.tileDecision(roll)
+        #Adjust c to less exploration and more exploitation as we get deeper
+        self.c = self.c/2
+        return tiles
+
+def play_benchmark_game(agent, game, dice, times):
+    """
+    Plays a game with agent, rolling from dice and appending the seconds of every decision to times
+    """
+    while game.getScore() > 0:
+        start = time.perf_counter()
+        diceUsed = agent.rollDecision(game)
+        times.append(time.perf_counter() - start)
+        roll = dice.roll(diceUsed)
+        start = time.perf_counter()
+        tilesToShut = agent.tileDecision(roll, game)
+        times.append(time.perf_counter() - start)
+        if tilesToShut is None:
+            break
+        game.playCombo(tilesToShut)
+    return game.getScore()
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q*len(sorted_values)))]
+
+def benchmark_agent(name, params, build_agent, games, seed, memory_games, rules):
+    """
+    Plays games seed..seed+games-1 with agents from make_agent(game), timing every decision, then replays the first
+    memory_games games under tracemalloc for the memory peak. build_agent() returns a make_agent with its own state
+    (caches, tables and solutions), called again under tracemalloc so the peak includes building that state.
+
+    Returns:
+        dict: Speed and strength of the agent
+    """
+    stats = RunningStats()
+    times = []
+    make_agent = build_agent()
+    for game_seed in range(seed, seed+games):
+        # Agents that search randomly (MCTS) draw from the global generator, seeded per game as well
+        random.seed(game_seed)
+        game = Game(2, rules=rules)
+        score = play_benchmark_game(make_agent(game), game, DiceSequence(game_seed, rules.faces), times)
+        stats.add(score, score == 0)
+    tracemalloc.start()
+    make_agent = build_agent()
+    for game_seed in range(seed, seed+memory_games):
+        random.seed(game_seed)
+        game = Game(2, rules=rules)
+        play_benchmark_game(make_agent(game), game, DiceSequence(game_seed, rules.faces), [])
+    memory_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times.sort()
+    total = sum(times)
+    return {
+        "agent": name,
+        "params": params,
+        "games": games,
+        "decisions": len(times),
+        "decisionsPerSecond": len(times)/total if total > 0 else None,
+        "decisionSeconds": {"mean": total/len(times), "p50": percentile(times, 0.5), "p90": percentile(times, 0.9),
+                            "p99": percentile(times, 0.99), "max": times[-1]},
+        "memoryPeakBytes": memory_peak,
+        "score": {"mean": stats.mean, "stddev": stats.stddev, "ci95": stats.meanInterval()},
+        "winRate": {"value": stats.winRate, "ci95": stats.winRateInterval()},
+    }
+
+def exact_agents(rules):
+    solver = ExactSolver(2, rules=rules)
+    # Solved again instead of taken from the solver module's cache, so a traced build counts the solution tables
+    solver.solution = Solution(rules)
+    return lambda game: solver
+
+def minimax_agents(depth):
+    # One cache shared by the agent's games, as minimax_seq does
+    cache = TranspositionCache()
+    return lambda game: Minimax(2, depth, cache)
+
+def mcts_agents(rounds):
+    return lambda game: MctsAgent(game, rounds)
+
+def table_agents(path):
+    policy = TablePolicy(path)
+    return lambda game: policy
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def agents(games, seed, minimax_depths, mcts_rounds, qlearn_episodes, memory_games, output, rules):
+    """
+    Speed and strength of every agent playing a variant of the game over the same seeded dice sequences, printed
+    as a table and written as JSON
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        # Trained Q-learning agent, played through its saved table as experiment.py table does
+        table = qlearning_dense.DenseQTable(seed=seed, rules=rules)
+        table.train(qlearn_episodes)
+        table_path = os.path.join(directory, "QTable.bin")
+        saveQTable(table_path, table.qdice, table.qcombo, table.moves.numTiles, table.eta, table.gamma, qlearn_episodes, rules)
+
+        # Builders of make_agent(game), each with fresh agent state
+        runs = [("exact", {}, partial(exact_agents, rules))]
+        for depth in minimax_depths:
+            runs.append(("minimax", {"depth": depth}, partial(minimax_agents, depth)))
+        for rounds in mcts_rounds:
+            runs.append(("mcts", {"rounds": rounds}, partial(mcts_agents, rounds)))
+        runs.append(("qlearn", {"episodes": qlearn_episodes}, partial(table_agents, table_path)))
+
+        results = []
+        print("{:>8} {:>16} {:>12} {:>12} {:>12} {:>10} {:>22} {:>20}".format(
+            "agent", "params", "decisions/s", "p50 ms", "p99 ms", "peak KB", "mean score (95% CI)", "win % (95% CI)"))
+        for name, params, make_agent in runs:
+            result = benchmark_agent(name, params, make_agent, games, seed, min(games, memory_games), rules)
+            results.append(result)
+            score, win = result["score"], result["winRate"]
+            print("{:>8} {:>16} {:>12.0f} {:>12.3f} {:>12.3f} {:>10.0f} {:>8.2f} ({:>5.2f}, {:>5.2f}) {:>6.2f} ({:>4.1f}, {:>4.1f})".format(
+                name, json.dumps(params), result["decisionsPerSecond"], result["decisionSeconds"]["p50"]*1000,
+                result["decisionSeconds"]["p99"]*1000, result["memoryPeakBytes"]/1024, score["mean"], score["ci95"][0],
+                score["ci95"][1], win["value"]*100, win["ci95"][0]*100, win["ci95"][1]*100))
+    report = {"commit": git_commit(), "python": platform.python_version(), "rules": rules.asDict(), "games": games, "seed": seed,
+              "agents": results}
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Wrote {}".format(output))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the Shut Box solution searching algorithms",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    minimax_parser = subparsers.add_parser(
+        "minimax-nodes",
+        help="Nodes/second of Minimax with deepcopy vs in-place (make/unmake) search",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    minimax_parser.add_argument(
+        "--depths",
+        type=int,
+        nargs="+",
+        default=[1, 2, 3, 4],
+        help="Minimax maxDepth values to benchmark"
+    )
+
+    memory_parser = subparsers.add_parser(
+        "mcts-memory",
+        help="Memory per node of the object and array MCTS trees",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    memory_parser.add_argument(
+        "--rounds",
+        type=int,
+        default=20000,
+        help="Simulation rounds used to grow each tree"
+    )
+    memory_parser.add_argument(
+        "--c",
+        type=float,
+        default=1,
+        help="Exploration constant"
+    )
+
+    scaling_parser = subparsers.add_parser(
+        "mcts-scaling",
+        help="Root-parallel MCTS throughput for several worker counts",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    scaling_parser.add_argument(
+        "--rounds",
+        type=int,
+        default=20000,
+        help="Simulation rounds per measurement"
+    )
+    scaling_parser.add_argument(
+        "--c",
+        type=float,
+        default=1,
+        help="Exploration constant"
+    )
+    scaling_parser.add_argument(
+        "--rollouts",
+        type=int,
+        default=1,
+        help="Vectorized rollouts per leaf (leaf parallelization)"
+    )
+    scaling_parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, 4, os.cpu_count()}),
+        help="Worker process counts to benchmark"
+    )
+    scaling_parser.add_argument(
+        "--games",
+        type=int,
+        default=100,
+        help="Seeded games played with each worker count to compare decision quality"
+    )
+    scaling_parser.add_argument(
+        "--game-rounds",
+        type=int,
+        default=experiment.MCTS_ROUNDS,
+        help="Simulation rounds per move of the seeded games, printed as rounds/move"
+    )
+    scaling_parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the first game"
+    )
+
+    updates_parser = subparsers.add_parser(
+        "qlearn-updates",
+        help="Q-table updates/second on the Q-learning training loop",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    updates_parser.add_argument(
+        "--episodes",
+        type=int,
+        default=20000,
+        help="Training episodes to run"
+    )
+
+    parallel_parser = subparsers.add_parser(
+        "qlearn-parallel",
+        help="Test win rate vs training time of dense Q-learning over several worker counts",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parallel_parser.add_argument(
+        "--episodes",
+        type=int,
+        default=200000,
+        help="Training episodes shared by all workers"
+    )
+    parallel_parser.add_argument(
+        "--test-episodes",
+        type=int,
+        default=100000,
+        help="Greedy test episodes played with the trained table"
+    )
+    parallel_parser.add_argument(
+        "--sync-every",
+        type=int,
+        default=1000,
+        help="Episodes each worker plays between merges into the shared table"
+    )
+    parallel_parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, 4, os.cpu_count()}),
+        help="Worker process counts to benchmark"
+    )
+    parallel_parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Base seed, worker i trains with the seed (seed, i)"
+    )
+
+    chunks_parser = subparsers.add_parser(
+        "experiment-chunks",
+        help="Throughput of experiment.py multiproc runs with one game per task vs chunks of games",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    chunks_parser.add_argument(
+        "--algorithm",
+        type=str,
+        choices=["minimax", "mcts"],
+        default="minimax",
+        help="Experiment to run"
+    )
+    chunks_parser.add_argument(
+        "--games",
+        type=int,
+        default=2000,
+        help="Games played by each run"
+    )
+    chunks_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Worker processes"
+    )
+
+    agents_parser = subparsers.add_parser(
+        "agents",
+        help="Decision speed, memory and strength of every agent over fixed seeded dice sequences, as JSON",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    agents_parser.add_argument(
+        "--games",
+        type=int,
+        default=100,
+        help="Games per agent; game i rolls the dice sequence of seed + i for every agent"
+    )
+    agents_parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the first game"
+    )
+    agents_parser.add_argument(
+        "--minimax-depths",
+        type=int,
+        nargs="+",
+        default=[2, 4, 6],
+        help="Minimax maxDepth values to benchmark"
+    )
+    agents_parser.add_argument(
+        "--mcts-rounds",
+        type=int,
+        nargs="+",
+        default=[100, 500],
+        help="MCTS simulation rounds per move to benchmark"
+    )
+    agents_parser.add_argument(
+        "--qlearn-episodes",
+        type=int,
+        default=100000,
+        help="Training episodes of the Q-learning agent"
+    )
+    agents_parser.add_argument(
+        "--memory-games",
+        type=int,
+        default=3,
+        help="Games replayed under tracemalloc to measure each agent's memory peak"
+    )
+    agents_parser.add_argument(
+        "--output",
+        type=str,
+        default="BenchmarkAgents.json",
+        help="JSON file of the results"
+    )
+    addRulesArguments(agents_parser)
+
+    args = parser.parse_args()
+    if "minimax-nodes" == args.benchmark:
+        minimax_nodes(args.depths)
+    elif "mcts-memory" == args.benchmark:
+        mcts_memory(args.rounds, args.c)
+    elif "mcts-scaling" == args.benchmark:
+        mcts_scaling(args.rounds, args.c, args.rollouts, args.workers, args.games, args.seed, args.game_rounds)
+    elif "qlearn-updates" == args.benchmark:
+        qlearn_updates(args.episodes)
+    elif "qlearn-parallel" == args.benchmark:
+        qlearn_parallel(args.episodes, args.test_episodes, args.sync_every, args.workers, args.seed)
+    elif "experiment-chunks" == args.benchmark:
+        experiment_chunks(args.algorithm, args.games, args.workers)
+    elif "agents" == args.benchmark:
+        agents(args.games, args.seed, args.minimax_depths, args.mcts_rounds, args.qlearn_episodes, args.memory_games, args.output,
+               rulesFromArguments(args))
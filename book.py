@@ -0,0 +1,128 @@
+from game import Game, getRules, rulesFromDict, tilesToMask
+from minimax import TranspositionCache
+from tablefile import BOOK, readTables, writeTables
+import os
+import numpy as np
+
+# Roll of the book entries holding dice choices, as no tile decision is made on a roll of 0
+DICE = 0
+
+
+class DecisionBook(TranspositionCache):
+    """
+    Opening/endgame book of decisions, shared by the agents of a variant's rules: the dice rolled on a board
+    (keyed by (mask, DICE)) and the combo mask shut on a board for a roll (keyed by (mask, roll)). Any agent
+    fills it with the decisions it searched and agents consulting it skip the search of a booked position.
+    Entries beyond maxSize are evicted least recently used first, and a book saved to a file is loaded back
+    with its entries in the same order.
+    """
+    def __init__(self, rules, maxSize=100000):
+        TranspositionCache.__init__(self, maxSize)
+        self.rules = rules
+
+    def peekDice(self, mask):
+        """
+        Dice choice of a board, without counting a lookup or refreshing the entry
+        """
+        return self.entries.get((mask, DICE))
+
+    def hasTiles(self, mask, roll):
+        return (mask, roll) in self.entries
+
+    def getDice(self, mask):
+        return self.get((mask, DICE))
+
+    def putDice(self, mask, dice):
+        self.put((mask, DICE), dice)
+
+    def getTiles(self, mask, roll):
+        return self.get((mask, roll))
+
+    def putTiles(self, mask, roll, combo):
+        self.put((mask, roll), combo)
+
+    def save(self, path):
+        """
+        Writes the book as a table file, oldest entries first
+        """
+        keys = list(self.entries)
+        header = {"kind": BOOK, "tiles": self.rules.numTiles, "rules": self.rules.asDict(), "eta": None, "gamma": None,
+                  "episodes": 0}
+        writeTables(path, header, {
+            "masks": np.array([mask for mask, _ in keys], dtype=np.uint16),
+            "rolls": np.array([roll for _, roll in keys], dtype=np.uint8),
+            "choices": np.array(list(self.entries.values()), dtype=np.uint16),
+        })
+
+    @classmethod
+    def load(cls, path, maxSize=100000):
+        header, arrays = readTables(path)
+        if header["kind"] != BOOK:
+            raise ValueError("{} is a {} table, not a book".format(path, header["kind"]))
+        book = cls(rulesFromDict(header["rules"]), maxSize)
+        for mask, roll, choice in zip(arrays["masks"].tolist(), arrays["rolls"].tolist(), arrays["choices"].tolist()):
+            book.put((mask, roll), choice)
+        return book
+
+
+def fillBook(book, policy, masks):
+    """
+    Adds the decisions of a policy with the rollDecision/tileDecision interface of Minimax on boards masks: its
+    dice choice where there is one and its tile choice for every roll with a combo to shut
+    """
+    rules = book.rules
+    for mask in masks:
+        game = Game.fromMask(2, rules.numTiles, mask, rules)
+        options = rules.maskDice[mask]
+        if len(options) > 1:
+            book.putDice(mask, policy.rollDecision(game))
+        for roll in range(options[0], rules.faces*options[-1]+1):
+            if len(game.validMasks(roll)) > 0:
+                book.putTiles(mask, roll, tilesToMask(policy.tileDecision(roll, game)))
+
+def bookBoards(rules, opening, endgame):
+    """
+    Boards of an opening/endgame book: every board with at most opening tiles shut or at most endgame tiles open
+    """
+    table = rules.table
+    return [mask for mask in range(1, table.fullMask+1)
+            if rules.numTiles - len(table.maskTiles[mask]) <= opening or len(table.maskTiles[mask]) <= endgame]
+
+def openBook(path, rules=None, maxSize=100000):
+    """
+    Loads the book at path, or starts an empty one when there is no file yet
+
+    Raises:
+        ValueError: If the book was filled under other rules
+    """
+    rules = rules if rules is not None else getRules()
+    if not os.path.exists(path):
+        return DecisionBook(rules, maxSize)
+    book = DecisionBook.load(path, maxSize)
+    if book.rules is not rules:
+        raise ValueError("{} is a book of {}, not {}".format(path, book.rules, rules))
+    return book
+
+
+if __name__ == '__main__':
+    import argparse
+    from game import addRulesArguments, rulesFromArguments
+    from minimax import Minimax
+    from solver import ExactSolver
+    parser = argparse.ArgumentParser(
+        description="Fill a decision book with the opening and endgame decisions of a policy, or print a book's size",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("command", choices=["exact", "minimax", "info"], help="Policy to fill the book with, or info to read path")
+    parser.add_argument("path", help="Book file, created when missing")
+    parser.add_argument("--opening", type=int, default=2, help="Book every board with at most this many tiles shut")
+    parser.add_argument("--endgame", type=int, default=3, help="Book every board with at most this many tiles open")
+    parser.add_argument("--depth", type=int, default=3, help="maxDepth of the minimax policy")
+    parser.add_argument("--size", type=int, default=100000, help="Max entries of the book")
+    addRulesArguments(parser)
+    args = parser.parse_args()
+    book = openBook(args.path, rulesFromArguments(args), args.size)
+    if "info" != args.command:
+        policy = ExactSolver(2, rules=book.rules) if "exact" == args.command else Minimax(2, args.depth)
+        fillBook(book, policy, bookBoards(book.rules, args.opening, args.endgame))
+        book.save(args.path)
+    print("{}: {} entries of {}".format(args.path, len(book), book.rules))
@@ -0,0 +1,225 @@
+from game import addRulesArguments, rulesFromArguments
+from tablefile import POLICY, TablePolicy, exactPolicyArrays, policyArrays
+from stats import RunningStats, ScoreDistribution
+from metrics import Metrics
+import itertools
+import time
+import numpy as np
+
+# Games played at once by BatchEvaluator.evaluate, which bounds its memory to a few arrays of this length
+BATCH_SIZE = 1 << 20
+# Most outcomes of throwing every die (faces**numDice) BatchEvaluator tabulates
+MAX_OUTCOMES = 1 << 16
+
+
+class BatchEvaluator:
+    """
+    Plays a fixed policy over many games at once, with the boards of the games held as a NumPy array of tile
+    masks. The policy is given as arrays in the tablefile.policyArrays layout (dice[mask] to roll and the combo
+    mask tiles[mask, roll] to shut), so a step of every game is a table lookup:
+
+        transitions[mask, outcome]   board after throwing outcome (one face per die) and playing the policy,
+                                     -1 when the policy's roll leaves no combo to shut
+
+    Outcomes are drawn uniformly in bulk, faces**numDice of them, and the first dice[mask] faces of an outcome
+    make the roll, so the rolls follow the exact dice distribution.
+    """
+    def __init__(self, rules, dice, tiles, seed=None):
+        self.rules = rules
+        self.rng = np.random.default_rng(seed)
+        table = rules.table
+        numMasks = table.fullMask + 1
+        dice = np.asarray(dice, dtype=np.int64)
+        tiles = np.asarray(tiles, dtype=np.int64)
+        # Roll total of the first d dice of every outcome
+        self.numOutcomes = rules.faces**rules.numDice
+        if self.numOutcomes > MAX_OUTCOMES:
+            raise ValueError("{} dice of {} faces have too many outcomes to tabulate".format(rules.numDice, rules.faces))
+        totals = np.zeros((rules.numDice+1, self.numOutcomes), dtype=np.int64)
+        for outcome, faces in enumerate(itertools.product(range(1, rules.faces+1), repeat=rules.numDice)):
+            totals[1:, outcome] = np.cumsum(faces)
+        # Whether every board can shut some combo for every roll, and the board the policy leads to
+        moves = np.zeros((numMasks, rules.maxRoll+1), dtype=bool)
+        for mask in range(numMasks):
+            for roll in range(min(rules.maxRoll, table.maxRoll)+1):
+                moves[mask, roll] = len(table.combos[mask][roll]) > 0
+        masks = np.arange(numMasks)[:, None]
+        rolls = totals[dice]
+        played = masks ^ tiles[masks, rolls]
+        self.transitions = np.where(moves[masks, rolls], played, -1).astype(np.int32)
+        self.transitions[0] = 0
+        self.score = np.array(rules.maskScore, dtype=np.int64)
+        self.games = 0
+        self.seconds = 0.0
+
+    def play(self, games, mask=None):
+        """
+        Plays games games from a board (the full board by default)
+
+        Returns:
+            ndarray: Final score of each game
+        """
+        start = self.rules.table.fullMask if mask is None else mask
+        final = np.zeros(games, dtype=np.int64)
+        active = np.arange(games)
+        masks = np.full(games, start, dtype=np.int32)
+        transitions = self.transitions
+        while len(active) > 0:
+            nextMasks = transitions[masks, self.rng.integers(0, self.numOutcomes, size=len(masks))]
+            # Games without a valid combo are over on their board, games with every tile shut on board 0
+            stuck = nextMasks < 0
+            final[active[stuck]] = masks[stuck]
+            playing = nextMasks > 0
+            active, masks = active[playing], nextMasks[playing]
+        return self.score[final]
+
+    def evaluate(self, games, mask=None, batchSize=BATCH_SIZE):
+        """
+        Plays games games batchSize at a time
+
+        Returns:
+            RunningStats: Final scores and wins (a score of 0) of the games
+        """
+        stats = RunningStats()
+        clock = time.perf_counter()
+        for done in range(0, games, batchSize):
+            scores = self.play(min(batchSize, games - done), mask)
+            stats.merge(RunningStats.fromArray(scores, np.count_nonzero(scores == 0)))
+        self.seconds += time.perf_counter() - clock
+        self.games += games
+        return stats
+
+    def report(self):
+        """
+        Returns:
+            Metrics: Games played and the time spent playing them
+        """
+        return Metrics({"games": self.games, "evaluateSeconds": self.seconds})
+
+
+def exactEvaluation(rules, dice, tiles, mask=None):
+    """
+    Exact distribution of the final score of a policy, given as arrays in the policyArrays layout, from a board
+    (the full board by default). Shutting tiles only clears bits, so the probability of reaching every board is
+    complete once every larger board has passed its probability on, and one pass over the boards in decreasing
+    order propagates it to the boards where games end.
+
+    Returns:
+        ScoreDistribution: Probability of every final score
+    """
+    table = rules.table
+    start = table.fullMask if mask is None else mask
+    reach = [0.0]*(table.fullMask+1)
+    reach[start] = 1.0
+    final = {}
+    for mask in range(start, 0, -1):
+        probability = reach[mask]
+        if probability == 0.0:
+            continue
+        combos = table.combos[mask]
+        policy = tiles[mask]
+        # Rolls without a combo to shut end the game on this board
+        ended = 0.0
+        for roll, rollProbability in enumerate(rules.distributions[int(dice[mask])]):
+            if rollProbability == 0.0:
+                continue
+            if roll <= table.maxRoll and len(combos[roll]) > 0:
+                reach[mask ^ int(policy[roll])] += probability*rollProbability
+            else:
+                ended += rollProbability
+        if ended > 0.0:
+            score = rules.maskScore[mask]
+            final[score] = final.get(score, 0.0) + probability*ended
+    if reach[0] > 0.0:
+        final[0] = final.get(0, 0.0) + reach[0]
+    return ScoreDistribution(final)
+
+
+def greedyArrays(rules, comboKey):
+    """
+    Policy arrays of a greedy heuristic: roll the fewest dice allowed once the open tiles add up to at most
+    one die's faces and the most dice otherwise, and shut the valid combo with the largest comboKey(tiles)
+
+    Returns:
+        tuple: dice[mask] and tiles[mask, roll] in the policyArrays layout
+    """
+    table = rules.table
+    numMasks = table.fullMask + 1
+    dice = np.zeros(numMasks, dtype=np.int8)
+    tiles = np.zeros((numMasks, rules.maxRoll+1), dtype=np.uint16)
+    for mask in range(1, numMasks):
+        options = rules.maskDice[mask]
+        dice[mask] = options[0] if table.maskScore[mask] <= rules.faces else options[-1]
+        for roll in range(1, rules.maxRoll+1):
+            combos = table.legalCombos(mask, roll)
+            if len(combos) > 0:
+                tiles[mask, roll] = max(combos, key = lambda combo: comboKey(table.maskTiles[combo]))
+    return dice, tiles
+
+# Greedy heuristics by name: shut the highest tiles first, or as few tiles as possible (highest first among those)
+HEURISTICS = {
+    "highest": lambda tiles: tiles[::-1],
+    "fewest": lambda tiles: (-len(tiles), tiles[::-1]),
+}
+
+def policyTables(policy, rules, path=None, depth=3):
+    """
+    Policy arrays of a named policy: exact, minimax (of maxDepth depth), table (the table file at path, which
+    is played under the rules it records) or one of HEURISTICS
+
+    Returns:
+        tuple: The rules the policy plays, dice[mask] and tiles[mask, roll]
+    """
+    if "exact" == policy:
+        dice, tiles, _ = exactPolicyArrays(rules)
+        return rules, dice, tiles
+    if "minimax" == policy:
+        from minimax import Minimax, TranspositionCache
+        dice, tiles = policyArrays(Minimax(2, depth, TranspositionCache()), rules)
+        return rules, dice, tiles
+    if "table" == policy:
+        table = TablePolicy(path)
+        if table.kind == POLICY:
+            return table.rules, table.arrays["dice"], table.arrays["tiles"]
+        # Q-tables are followed greedily, as TablePolicy plays them
+        dice, tiles = policyArrays(table, table.rules)
+        return table.rules, dice, tiles
+    dice, tiles = greedyArrays(rules, HEURISTICS[policy])
+    return rules, dice, tiles
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(
+        description="Evaluate a policy over many games played at once as NumPy arrays",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("policy", choices=["exact", "minimax", "table"] + list(HEURISTICS), help="Policy to evaluate")
+    parser.add_argument("--games", type=int, default=10000000, help="Games to play")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dice")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Games played at once")
+    parser.add_argument("--table", type=str, default="QTable.bin", help="Table file of the table policy")
+    parser.add_argument("--depth", type=int, default=3, help="maxDepth of the minimax policy")
+    parser.add_argument("--exact", action="store_true", help="Compute the exact score distribution instead of playing games")
+    addRulesArguments(parser)
+    args = parser.parse_args()
+    rules, dice, tiles = policyTables(args.policy, rulesFromArguments(args), args.table, args.depth)
+    if args.exact:
+        clock = time.perf_counter()
+        distribution = exactEvaluation(rules, dice, tiles)
+        seconds = time.perf_counter() - clock
+        print("{} on {}".format(args.policy, rules))
+        print("Exact in {:.2f} milliseconds".format(seconds*1000))
+        print("Mean score: {:.6f}\tStdDv: {:.6f}".format(distribution.mean, distribution.stddev))
+        print("Win rate: {:.6%}".format(distribution.winRate))
+        print("Scores: {}".format(", ".join("{}: {:.6f}".format(score, probability)
+                                            for score, probability in distribution.histogram.items())))
+        sys.exit()
+    evaluator = BatchEvaluator(rules, dice, tiles, args.seed)
+    stats = evaluator.evaluate(args.games, batchSize=args.batch_size)
+    low, high = stats.meanInterval()
+    winLow, winHigh = stats.winRateInterval()
+    print("{} on {}".format(args.policy, rules))
+    print("Games: {:,} in {:.2f} seconds ({:,.0f} games/second)".format(stats.count, evaluator.seconds, stats.count/evaluator.seconds))
+    print("Mean score: {:.4f} (95% CI {:.4f}, {:.4f})\tStdDv: {:.4f}".format(stats.mean, low, high, stats.stddev))
+    print("Win rate: {:.4%} (95% CI {:.4%}, {:.4%})".format(stats.winRate, winLow, winHigh))
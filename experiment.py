@@ -1,93 +1,256 @@
-from game import Game, rollProb
-from minimax import Minimax
+from game import Game, addRulesArguments, rulesFromArguments
+from minimax import Minimax, TranspositionCache
+from book import openBook
+from solver import ExactSolver
+from tablefile import TablePolicy
+from results import ResultWriter, packResults
+from metrics import Metrics, writeReport
 import ShutTheBox_QLearning as qlearn
 import montecarlo as mcts
+from montecarlo_array import ArrayMonteCarlo
+from montecarlo_dag import TranspositionMonteCarlo
 import argparse
-import numpy as np
+import contextlib
+import logging
+import os
+import random
+import sys
+import time
 import psutil           # For getting number of CPUs
+from functools import partial
 from multiprocessing import Pool
-from profilehooks import profile, timecall # For timing info
-from statistics import mean, pstdev
+import cProfile
+import pstats
 
 # Experiment config variables
 CPU_NUM = psutil.cpu_count(logical=False)
 MCTS_ROUNDS = 1000 # Rounds of each mcts simulation
+MCTS_ROLLOUTS = 1 # Vectorized rollouts per mcts leaf, 1 plays a single sequential rollout
+MCTS_TREES = {"objects": mcts.MonteCarlo, "arrays": ArrayMonteCarlo, "dag": TranspositionMonteCarlo}
 MINIMAX_MAXDEPTH = 10 # Maxdepth of the mini(max)-mizing search
+MINIMAX_CACHE_SIZE = 100000 # Max entries of the minimax transposition cache, shared by every game of a process
+CHUNKS_PER_WORKER = 4 # Chunks of games handed to each worker process by the multiproc experiments
+BOOK_SIZE = 100000 # Max entries of the decision book, least recently used entries are evicted beyond it
 
-# @profile
-@timecall(immediate=True)
-def mcts_multiproc(n):
-    results = None
-    with Pool(CPU_NUM) as pool:
-        results = pool.starmap(mcts_experiment, np.repeat([(1, MCTS_ROUNDS, MCTS_ROUNDS*10)], n, axis=0))
-    return results
-
-@profile(immediate=True)
-# @timecall(immediate=True)
-def mcts_seq(n):
-    results = []
-    for _ in range(n):
-        results.append(mcts_experiment(1, MCTS_ROUNDS, MCTS_ROUNDS*10))
-    return results
-
-# @profile
-@timecall(immediate=True)
-def minimax_multiproc(n):
+log = logging.getLogger("experiment")
+
+# Transposition cache of a minimax_multiproc worker process
+worker_cache = None
+# Memory-mapped policy of a table_multiproc worker process
+worker_policy = None
+# Decision book of an mcts_multiproc or minimax_multiproc worker process, loaded when it starts
+worker_book = None
+
+def mcts_multiproc(n, out, seed=0, tree="objects", rules=None, book_path=None):
+    # Load the book here first so a bad file fails before the workers start
+    open_book(book_path, rules)
+    with Pool(CPU_NUM, initializer=init_book_worker, initargs=(book_path, rules)) as pool:
+        return run_chunks(pool, partial(mcts_chunk, tree=tree, rules=rules), n, out, seed)
+
+def mcts_chunk(seeds, tree="objects", rules=None):
+    return play_chunk(seeds, mcts_experiment, 1, MCTS_ROUNDS, MCTS_ROUNDS*10, MCTS_ROLLOUTS, tree, 1, rules, worker_book)
+
+def mcts_seq(n, out, seed=0, tree="objects", workers=1, rules=None, book_path=None):
+    metrics = Metrics()
+    book = open_book(book_path, rules)
+    for game_seed in range(seed, seed+n):
+        record_result(out, metrics, seeded_experiment(game_seed, mcts_experiment, 1, MCTS_ROUNDS, MCTS_ROUNDS*10, MCTS_ROLLOUTS, tree, workers, rules, book))
+    save_book(book, book_path)
+    return metrics
+
+def minimax_multiproc(n, out, seed=0, rules=None, book_path=None):
+    open_book(book_path, rules)
+    with Pool(CPU_NUM, initializer=init_minimax_worker, initargs=(MINIMAX_CACHE_SIZE, book_path, rules)) as pool:
+        return run_chunks(pool, partial(minimax_chunk, rules=rules), n, out, seed)
+
+def init_minimax_worker(cache_size, book_path=None, rules=None):
+    global worker_cache
+    worker_cache = TranspositionCache(cache_size)
+    init_book_worker(book_path, rules)
+
+def minimax_chunk(seeds, rules=None):
+    return play_chunk(seeds, minimax_experiment, MINIMAX_MAXDEPTH, worker_cache, rules, worker_book)
+
+def minimax_seq(n, out, seed=0, rules=None, book_path=None):
+    metrics = Metrics()
+    cache = TranspositionCache(MINIMAX_CACHE_SIZE)
+    book = open_book(book_path, rules)
+    for game_seed in range(seed, seed+n):
+        record_result(out, metrics, seeded_experiment(game_seed, minimax_experiment, MINIMAX_MAXDEPTH, cache, rules, book))
+    log.info("Transposition cache: %s", cache.stats())
+    save_book(book, book_path)
+    return metrics
+
+def init_book_worker(book_path, rules):
+    # Workers play from the book as loaded and add to their own copy, which is not saved
+    global worker_book
+    worker_book = open_book(book_path, rules)
+
+def open_book(book_path, rules):
+    return openBook(book_path, rules, BOOK_SIZE) if book_path is not None else None
+
+def save_book(book, book_path):
+    if book is not None:
+        log.info("Decision book: %s", book.stats())
+        book.save(book_path)
+
+def exact_multiproc(n, out, seed=0, rules=None):
     with Pool(CPU_NUM) as pool:
-        results = pool.map(minimax_experiment, np.repeat(MINIMAX_MAXDEPTH, n))
-    return results
-
-@profile(immediate=True)
-def minimax_seq(n):
-    results = []
-    for _ in range(n):
-        results.append(minimax_experiment(MINIMAX_MAXDEPTH))
-    return results
-
-def display_results(results):
-    if None == results:
-        print("results is None somehow")
+        return run_chunks(pool, partial(exact_chunk, rules=rules), n, out, seed)
+
+def exact_chunk(seeds, rules=None):
+    return play_chunk(seeds, exact_experiment, rules)
+
+def exact_seq(n, out, seed=0, rules=None):
+    metrics = Metrics()
+    for game_seed in range(seed, seed+n):
+        record_result(out, metrics, seeded_experiment(game_seed, exact_experiment, rules))
+    return metrics
+
+def table_multiproc(n, out, path, seed=0):
+    # Map the file here first so a bad path fails before the workers start
+    TablePolicy(path)
+    # Every worker maps the same file, so the table is loaded once into the page cache and shared
+    with Pool(CPU_NUM, initializer=init_table_worker, initargs=(path,)) as pool:
+        return run_chunks(pool, table_chunk, n, out, seed)
+
+def init_table_worker(path):
+    global worker_policy
+    worker_policy = TablePolicy(path)
+
+def table_chunk(seeds):
+    return play_chunk(seeds, table_experiment, worker_policy)
+
+def table_seq(n, out, path, seed=0):
+    metrics = Metrics()
+    policy = TablePolicy(path)
+    for game_seed in range(seed, seed+n):
+        record_result(out, metrics, seeded_experiment(game_seed, table_experiment, policy))
+    return metrics
+
+def run_chunks(pool, chunk_worker, n, out, seed=0, workers=CPU_NUM):
+    """
+    Splits games seed..seed+n-1 into CHUNKS_PER_WORKER chunks per worker process of pool and appends the packed
+    results of every chunk to out in the order the chunks finish
+
+    Returns:
+        Metrics: Counters and timers of the games, merged over the chunks
+    """
+    metrics = Metrics()
+    chunk_size = max(1, -(-n // (workers*CHUNKS_PER_WORKER)))
+    chunks = [range(start, min(start+chunk_size, seed+n)) for start in range(seed, seed+n, chunk_size)]
+    for records, chunk_metrics in pool.imap_unordered(chunk_worker, chunks):
+        out.writeRecords(records)
+        metrics.merge(chunk_metrics)
+        log.info("%d/%d games", out.stats.count, n)
+    return metrics
+
+def play_chunk(seeds, experiment, *args):
+    """
+    Plays one game of an experiment per seed with stdout and logging silenced
+
+    Returns:
+        tuple: Packed results of the games (see results.packResults) and their merged Metrics
+    """
+    metrics = Metrics()
+    logging.disable(logging.CRITICAL)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = [seeded_experiment(seed, experiment, *args) for seed in seeds]
+    finally:
+        logging.disable(logging.NOTSET)
+    for result in results:
+        metrics.merge(result[4])
+    return packResults([result[:4] for result in results]), metrics
+
+def seeded_experiment(seed, experiment, *args):
+    """
+    Plays one game of an experiment with the random module seeded by seed
+
+    Returns:
+        list: Final score, tiles left, seed, seconds taken and the Metrics of the game
+    """
+    random.seed(seed)
+    start = time.perf_counter()
+    score, tiles, metrics = experiment(*args)
+    return [score, tiles, seed, time.perf_counter() - start, metrics]
+
+def record_result(out, metrics, result):
+    """
+    Logs a game result as it arrives, appends it to the results file of out and adds its Metrics to metrics
+    """
+    log.info("%d: Score: %s; Tiles: %s", out.stats.count+1, result[0], result[1])
+    out.write(*result[:4])
+    metrics.merge(result[4])
+
+def display_results(stats, metrics):
+    if 0 == stats.count:
+        print("No results")
     else:
         print("Results:")
-        [print(f"{i+1}: Score: {result[0]}; Tiles: {result[1]}") for i, result in enumerate(results)]
-        #[print(f"{i+1}: Score: {result[0]}; Tiles: {result[1]}") for i, result in enumerate(results)]
-        scores = list(map(lambda r: r[0],results))
-        wins = len(list(filter(lambda score: score == 0, scores)))
-        print("Av: {}\tStdDv: {} Win%: {}".format(mean(scores), pstdev(scores), wins/len(scores)))
-
-def mcts_experiment(c, n, max_iter):
-    mc = mcts.MonteCarlo(Game(2, 9), max_iter)
-    mc.simulate(n, c)
+        print(stats)
+        print(metrics)
+
+def mcts_experiment(c, n, max_iter, rollouts=1, tree="objects", workers=1, rules=None, book=None):
+    # Only the object tree supports root-parallel search and decision books
+    options = {"workers": workers} if workers > 1 else {}
+    if book is not None:
+        options["book"] = book
+    mc = MCTS_TREES[tree](Game(2, rules=rules), max_iter, **options)
+    # Checked once per game so disabled move logs cost nothing per move
+    debug = log.isEnabledFor(logging.DEBUG)
+    mc.simulate(n, c, rollouts)
     while(mc.state.getScore() > 0):
-        print("Score: {}\t Tiles:{}".format(mc.state.getScore(), mc.state.tiles))
-        mc.simulate(n, c)
+        if debug:
+            log.debug("Score: %s\t Tiles:%s", mc.state.getScore(), mc.state.tiles)
+        mc.simulate(n, c, rollouts)
         #ROUND_START_STATE node
         diceUsed = mc.rollDecision()
-        print(mc.rootNode.games)
+        if debug:
+            log.debug("Root games: %s", mc.rootGames())
         #PRE_ROLL_STATE node
         roll = mc.state.rollDice(diceUsed)
         tilesToShut = mc.tileDecision(roll)
-        print(mc.rootNode.games)
+        if debug:
+            log.debug("Root games: %s", mc.rootGames())
         #Adjust c to less exploration and more exploitation as we get deeper
         c = c/2
         if None == tilesToShut:
             break
-    return [mc.state.getScore(), mc.state.tiles]
+    if workers > 1:
+        mc.close()
+    return [mc.state.getScore(), mc.state.tiles, mc.report()]
+
+def minimax_experiment(maxdepth, cache=None, rules=None, book=None):
+    score, tiles, metrics = policy_experiment(Game(2, rules=rules), Minimax(2, maxdepth, cache, book=book))
+    if cache is not None:
+        metrics.peak("cacheSize", len(cache))
+    return [score, tiles, metrics]
 
-def minimax_experiment(maxdepth):
-    game = Game(2, 9)
-    minimax = Minimax(2, maxdepth)
+def exact_experiment(rules=None):
+    game = Game(2, rules=rules)
+    return policy_experiment(game, ExactSolver(2, rules=game.rules))
+
+def table_experiment(policy):
+    # A table is played under the rules it was built for
+    return policy_experiment(Game(2, rules=policy.rules), policy)
+
+def policy_experiment(game, policy):
+    debug = log.isEnabledFor(logging.DEBUG)
     while(game.getScore() > 0):
-        print("Score: {}\t Tiles:{}".format(game.getScore(), game.tiles))
-        diceUsed = minimax.rollDecision(game)
+        if debug:
+            log.debug("Score: %s\t Tiles:%s", game.getScore(), game.tiles)
+        diceUsed = policy.rollDecision(game)
         roll = game.rollDice(diceUsed)
-        tilesToShut = minimax.tileDecision(roll, game)
-        print("Roll: {}\t Shutting: {}".format(roll, tilesToShut))
+        tilesToShut = policy.tileDecision(roll, game)
+        if debug:
+            log.debug("Roll: %s\t Shutting: %s", roll, tilesToShut)
         if tilesToShut != None:
             game.playCombo(tilesToShut)
         else:
             break
-    return [game.getScore(), game.tiles]
+    # Policies without counters of their own (exact, table) report nothing
+    return [game.getScore(), game.tiles, policy.report() if hasattr(policy, "report") else Metrics()]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -97,14 +260,20 @@ if __name__ == "__main__":
     parser.add_argument(
         "algorithm_type", 
         type=str, 
-        choices=["mcts","minimax","qlearn"],
+        choices=["mcts","minimax","exact","qlearn","table"],
         help="Algorithm type of the experiment to run"
     )
     parser.add_argument(
         "--iteration",
         type=int,
-        default=200,
-        help="Number of iterations of the experiment"
+        default=None,
+        help="Number of iterations of the experiment (default 200), or test episodes of qlearn (default 10000)"
+    )
+    parser.add_argument(
+        "--qlearn-episodes",
+        type=int,
+        default=100000,
+        help="Training episodes of qlearn"
     )
 
     parser.add_argument(
@@ -112,7 +281,53 @@ if __name__ == "__main__":
         type=str,
         choices=["on","off"],
         default="off",
-        help="Use multiprocessing to attempt to speed up experiment (mcts, minimax)."
+        help="Use multiprocessing to attempt to speed up experiment (mcts, minimax, exact, table)."
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the first game, game i of the experiment is played with seed + i"
+    )
+
+    parser.add_argument(
+        "--results",
+        type=str,
+        default="ExperimentResults.bin",
+        help="Results file every game is appended to as it finishes (read it with results.py)"
+    )
+
+    parser.add_argument(
+        "--table",
+        type=str,
+        default="QTable.bin",
+        help="Table file played by the table experiment: a Q-table or a policy saved with tablefile.py"
+    )
+
+    parser.add_argument(
+        "--mcts-tree",
+        type=str,
+        choices=list(MCTS_TREES),
+        default="objects",
+        help="Tree used by mcts: object nodes, typed arrays, or a transposition DAG keyed by board"
+    )
+
+    parser.add_argument(
+        "--mcts-workers",
+        type=int,
+        default=1,
+        help="Worker processes for root-parallel search within each mcts move (objects tree, without --multiproc)"
+    )
+
+    # Variant of the game played by every algorithm (table plays the variant recorded in its file)
+    addRulesArguments(parser)
+
+    parser.add_argument(
+        "--book",
+        type=str,
+        default=None,
+        help="Decision book file of mcts (objects tree) and minimax, loaded at start and saved after sequential runs"
     )
 
     parser.add_argument(
@@ -123,22 +338,81 @@ if __name__ == "__main__":
         help="Additionally calls any graph plotting/ saving functions if available"
     )
     
-    args = parser.parse_args()
-    results = None
-    n = args.iteration
-    if "mcts" == args.algorithm_type:
-        if "on" == args.multiproc:
-            results = mcts_multiproc(n)
-        else:
-            results = mcts_seq(n)
-        display_results(results)
-    elif "minimax" == args.algorithm_type:
-        if "on" == args.multiproc:
-            results = minimax_multiproc(n)
-        else:
-            results = minimax_seq(n)
-        display_results(results)        
-    elif "qlearn" == args.algorithm_type:
-        qlearn.main()
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        choices=["DEBUG","INFO","WARNING"],
+        default="INFO",
+        help="INFO logs every game result, DEBUG also every move and MCTS simulation"
+    )
 
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Only log warnings; the final results are still printed"
+    )
 
+    parser.add_argument(
+        "--report",
+        type=str,
+        default="ExperimentReport.json",
+        help="JSON report of the run: settings, wall-clock time, result statistics and algorithm counters/timers"
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Run under cProfile and print the 40 most expensive calls (workers of --multiproc on are not profiled)"
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level="WARNING" if args.quiet else args.log_level)
+    if args.mcts_workers > 1 and ("on" == args.multiproc or "objects" != args.mcts_tree):
+        parser.error("--mcts-workers needs --multiproc off and --mcts-tree objects")
+    if args.book is not None and ("mcts" == args.algorithm_type and "objects" != args.mcts_tree):
+        parser.error("--book needs --mcts-tree objects")
+    n = args.iteration if args.iteration is not None else (10000 if "qlearn" == args.algorithm_type else 200)
+    rules = rulesFromArguments(args)
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    if "qlearn" == args.algorithm_type:
+        # Training and test episodes are both appended to --results, tagged qlearn-train and qlearn-test
+        metrics, stats = qlearn.main(args.qlearn_episodes, n, resultsPath=args.results, rules=rules, seed=args.seed)
+    else:
+        with ResultWriter(args.results, args.algorithm_type) as out:
+            if "mcts" == args.algorithm_type:
+                if "on" == args.multiproc:
+                    metrics = mcts_multiproc(n, out, args.seed, args.mcts_tree, rules, args.book)
+                else:
+                    metrics = mcts_seq(n, out, args.seed, args.mcts_tree, args.mcts_workers, rules, args.book)
+            elif "minimax" == args.algorithm_type:
+                if "on" == args.multiproc:
+                    metrics = minimax_multiproc(n, out, args.seed, rules, args.book)
+                else:
+                    metrics = minimax_seq(n, out, args.seed, rules, args.book)
+            elif "exact" == args.algorithm_type:
+                if "on" == args.multiproc:
+                    metrics = exact_multiproc(n, out, args.seed, rules)
+                else:
+                    metrics = exact_seq(n, out, args.seed, rules)
+            elif "table" == args.algorithm_type:
+                if "on" == args.multiproc:
+                    metrics = table_multiproc(n, out, args.table, args.seed)
+                else:
+                    metrics = table_seq(n, out, args.table, args.seed)
+        stats = out.stats
+        display_results(stats, metrics)
+    seconds = time.perf_counter() - start
+    if profiler is not None:
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(40)
+    print("Finished in {:.3f} seconds".format(seconds))
+    report = {"algorithm": args.algorithm_type, "iterations": n, "seed": args.seed, "multiproc": args.multiproc,
+              "mctsTree": args.mcts_tree, "rules": rules.asDict(), "seconds": seconds, "results": stats, "metrics": metrics}
+    if "qlearn" == args.algorithm_type:
+        # iterations are the test episodes, whose scores are the results
+        report["trainingEpisodes"] = args.qlearn_episodes
+    writeReport(args.report, report)
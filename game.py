@@ -1,77 +1,310 @@
 import random
 import itertools
+import logging
+import operator
+
+log = logging.getLogger(__name__)
+
+DIE_FACES = 6
+
+class MoveTable(object):
+  """
+  Precomputed bitmask move table for a box of numTiles tiles. Tile t is bit (t-1) of a board mask.
+
+  combos[mask][roll] holds the combo masks that can be shut on board mask for that roll (in the same
+  order itertools.combinations would produce them) and nextMasks[mask][roll] the boards they lead to.
+  """
+  def __init__(self, numTiles):
+    self.numTiles = numTiles
+    self.fullMask = (1 << numTiles) - 1
+    self.maxRoll = numTiles*(numTiles+1)//2
+    numMasks = self.fullMask + 1
+
+    self.maskTiles = [tuple(t+1 for t in range(numTiles) if mask >> t & 1) for mask in range(numMasks)]
+    self.maskScore = [sum(tiles) for tiles in self.maskTiles]
+    self.maskMaxTile = [max(tiles) if tiles else 0 for tiles in self.maskTiles]
+
+    # Rank of every combo mask in the order itertools.combinations produces combos of the full box
+    comboRank = [0]*numMasks
+    allTiles = range(1, numTiles+1)
+    rank = 0
+    for i in range(numTiles+1):
+      for combo in itertools.combinations(allTiles, i):
+        comboRank[tilesToMask(combo)] = rank
+        rank += 1
+
+    empty = ()
+    self.combos = []
+    self.nextMasks = []
+    for mask in range(numMasks):
+      bySum = [[] for _ in range(self.maxRoll+1)]
+      # Walk every submask of the board, the combos that can be shut from it
+      combo = mask
+      while True:
+        bySum[self.maskScore[combo]].append(combo)
+        if combo == 0:
+          break
+        combo = (combo-1) & mask
+      maskCombos = []
+      maskNext = []
+      for valid in bySum:
+        if valid:
+          valid.sort(key=comboRank.__getitem__)
+          maskCombos.append(tuple(valid))
+          maskNext.append(tuple(mask ^ combo for combo in valid))
+        else:
+          maskCombos.append(empty)
+          maskNext.append(empty)
+      self.combos.append(maskCombos)
+      self.nextMasks.append(maskNext)
+
+  def legalCombos(self, mask, roll):
+    if roll < 0 or roll > self.maxRoll:
+      return ()
+    return self.combos[mask][roll]
+
+  def legalNextMasks(self, mask, roll):
+    if roll < 0 or roll > self.maxRoll:
+      return ()
+    return self.nextMasks[mask][roll]
+
+_moveTables = {}
+
+def getMoveTable(numTiles):
+  """
+  Returns the MoveTable for numTiles, building it on first use
+  """
+  table = _moveTables.get(numTiles)
+  if table is None:
+    table = MoveTable(numTiles)
+    _moveTables[numTiles] = table
+  return table
+
+def tilesToMask(tiles):
+  mask = 0
+  for tile in tiles:
+    mask |= 1 << (tile-1)
+  return mask
+
+SCORE_SUM = "sum"
+SCORE_DIGITS = "digits"
+
+class Rules(object):
+  """
+  Rules of a Shut The Box variant, with every table an agent needs built once per variant (see getRules).
+
+  numTiles: tiles 1..numTiles start open
+  numDice: dice of the box, all of which must be rolled while a tile above oneDieThreshold is open
+  oneDieThreshold: once no open tile is above it, any number of dice from 1 to numDice may be rolled
+  faces: faces of every die
+  scoring: SCORE_SUM scores the sum of the open tiles, SCORE_DIGITS reads them in order as the digits of
+           one number (1, 4 and 7 open score 147). Either way a shut box scores 0, which is a win.
+  """
+  def __init__(self, numTiles=9, numDice=2, oneDieThreshold=6, faces=DIE_FACES, scoring=SCORE_SUM):
+    if scoring not in (SCORE_SUM, SCORE_DIGITS):
+      raise ValueError("Unknown scoring {}".format(scoring))
+    if numDice < 1:
+      raise ValueError("Invalid number of dice {} - must be at least 1".format(numDice))
+    self.numTiles = numTiles
+    self.numDice = numDice
+    self.oneDieThreshold = oneDieThreshold
+    self.faces = faces
+    self.scoring = scoring
+    self.table = getMoveTable(numTiles)
+    # Largest roll total, so roll-indexed tables have maxRoll+1 entries
+    self.maxRoll = numDice*faces
+    numMasks = self.table.fullMask + 1
+
+    if scoring == SCORE_SUM:
+      self.maskScore = self.table.maskScore
+    else:
+      self.maskScore = [int("".join(map(str, tiles))) if tiles else 0 for tiles in self.table.maskTiles]
+    self.fullScore = self.maskScore[self.table.fullMask]
+    # distributions[dice] is the roll distribution of dice dice, padded to maxRoll+1 totals
+    self.distributions = [None]
+    for dice in range(1, numDice+1):
+      distribution = rollDistribution(dice, faces)
+      self.distributions.append(distribution + (0.0,)*(self.maxRoll+1 - len(distribution)))
+    # Dice counts that may be rolled on every board, in increasing order: every die must be rolled while a tile
+    # above oneDieThreshold is open, and any number of dice once none is
+    allDice = tuple(range(1, numDice+1))
+    self.maskDice = [allDice if self.table.maskMaxTile[mask] <= oneDieThreshold else (numDice,)
+                     for mask in range(numMasks)]
+
+  def key(self):
+    return (self.numTiles, self.numDice, self.oneDieThreshold, self.faces, self.scoring)
+
+  def asDict(self):
+    return {"tiles": self.numTiles, "dice": self.numDice, "oneDieThreshold": self.oneDieThreshold,
+            "faces": self.faces, "scoring": self.scoring}
+
+  def diceOptions(self, mask):
+    return self.maskDice[mask]
+
+  def __reduce__(self):
+    # Processes rebuild (or reuse) their own cached tables instead of unpickling them
+    return (getRules, self.key())
+
+  def __repr__(self):
+    return "Rules({}, {}, {}, {}, {!r})".format(*self.key())
+
+_rules = {}
+
+def getRules(numTiles=9, numDice=2, oneDieThreshold=6, faces=DIE_FACES, scoring=SCORE_SUM):
+  """
+  Returns the Rules of a variant, building its tables on first use
+  """
+  key = (numTiles, numDice, oneDieThreshold, faces, scoring)
+  rules = _rules.get(key)
+  if rules is None:
+    rules = Rules(*key)
+    _rules[key] = rules
+  return rules
+
+def rulesFromDict(values):
+  """
+  Returns the Rules described by a dict from Rules.asDict, with missing entries at their defaults
+  """
+  return getRules(values.get("tiles", 9), values.get("dice", 2), values.get("oneDieThreshold", 6),
+                  values.get("faces", DIE_FACES), values.get("scoring", SCORE_SUM))
+
+def addRulesArguments(parser):
+  """
+  Adds the options of the game variant to an argparse parser, read back by rulesFromArguments
+  """
+  parser.add_argument("--tiles", type=int, default=9, help="Tiles of the box")
+  parser.add_argument("--dice", type=int, default=2, help="Dice of the box")
+  parser.add_argument("--one-die-threshold", type=int, default=6,
+                      help="Fewer dice may be rolled once no open tile is above this")
+  parser.add_argument("--scoring", choices=[SCORE_SUM, SCORE_DIGITS], default=SCORE_SUM,
+                      help="Score the open tiles by their sum or as the digits of one number")
+
+def rulesFromArguments(args):
+  return getRules(args.tiles, args.dice, args.one_die_threshold, DIE_FACES, args.scoring)
 
 class Game(object):
-  def __init__(self, players, numTiles):
+  def __init__(self, players, numTiles=9, rules=None):
     self.players = players
-    self.tiles = []
-    for i in range(numTiles):
-      self.tiles.append(i+1) 
-  
-  def __deepcopy__(self, memodict={}):
-    copy_game =  Game(self.players, 0)
-    
-    for tile in self.tiles:
-      copy_game.tiles.append(tile)
+    # The standard rules of a numTiles box unless a variant is given
+    self.rules = rules if rules is not None else getRules(numTiles)
+    self.table = self.rules.table
+    self.mask = self.table.fullMask
+
+  @classmethod
+  def fromMask(cls, players, numTiles, mask, rules=None):
+    game = cls(players, numTiles, rules)
+    game.mask = mask
+    return game
+
+  @property
+  def tiles(self):
+    return list(self.table.maskTiles[self.mask])
+
+  @tiles.setter
+  def tiles(self, tiles):
+    self.mask = tilesToMask(tiles)
+
+  @property
+  def numTiles(self):
+    return self.table.numTiles
 
+  def __deepcopy__(self, memodict={}):
+    copy_game = Game.__new__(Game)
+    copy_game.players = self.players
+    copy_game.rules = self.rules
+    copy_game.table = self.table
+    copy_game.mask = self.mask
     return copy_game
 
   def rollDice(self, numDice):
-    roll = 0 
+    roll = 0
     for i in range(numDice):
-      roll += random.randint(1, 6)
+      roll += random.randint(1, self.rules.faces)
     #print('Dice roll: ', roll)
     return roll
 
   def rollCombos(self, roll):
-    valid = []
-    for i in range(len(self.tiles)+1):
-      for combo in itertools.combinations(self.tiles, i):
-        if sum(combo) == roll:
-          valid.append(combo)
+    maskTiles = self.table.maskTiles
+    valid = [maskTiles[combo] for combo in self.table.legalCombos(self.mask, roll)]
     #print('All roll combinations: ', valid)
     return valid
 
   def validCombos(self, roll):
-    valid = []
-    allCombos = self.rollCombos(roll)
-    # Check all combos and see if every tile exists in current tiles. If so, it's a valid move
-    for combo in allCombos:
-      if set(self.tiles).issuperset(set(combo)):
-        valid.append(combo)
-    return valid
+    # Combos are drawn from the open tiles, so every combo in the move table is already a valid move
+    return self.rollCombos(roll)
+
+  def validMasks(self, roll):
+    """
+    Returns the board masks reachable from the current board with the given roll
+    """
+    return self.table.legalNextMasks(self.mask, roll)
 
   def playCombo(self, combo):
-    for value in combo:
-      self.tiles.remove(value)
+    comboMask = tilesToMask(combo)
+    if comboMask & self.mask != comboMask:
+      raise ValueError("Combo {} is not open on tiles {}".format(combo, self.tiles))
+    self.mask ^= comboMask
     #print('tiles remaining: ', self.tiles)
     return self
 
   def getScore(self):
-    return sum(self.tiles)
+    return self.rules.maskScore[self.mask]
+
+  def diceOptions(self):
+    """
+    Returns the numbers of dice that may be rolled on the current board
+    """
+    return self.rules.maskDice[self.mask]
 
   def maxTileRemaining(self):
-    return max(self.tiles)
+    return self.table.maskMaxTile[self.mask]
 
-def rollProb(diceRolled, desiredValue):
+_rollDistributions = {}
+
+def rollDistribution(diceRolled, faces=DIE_FACES):
     """
-    Method to compute roll probability, formula for 2 dice from WolframAlpha (line 16): https://mathworld.wolfram.com/Dice.html
+    Probability of every total of rolling diceRolled dice with faces faces, built once per configuration by
+    convolving the single die distribution diceRolled times
+
+    Returns:
+        tuple: probabilities[total] for total 0..diceRolled*faces (0 below diceRolled)
     """
-    if diceRolled == 1:
-        return 1/6
-    elif diceRolled == 2:
-        if desiredValue >= 2 and desiredValue <= 12:
-            return (6-abs(desiredValue-7))/36
-        else:
-            print("Invalid roll value - must be between 2 and 12 for 2 dice")
-            return None
-    else:
-        print("Invalid number of dice - must be 1 or 2")
+    key = (diceRolled, faces)
+    distribution = _rollDistributions.get(key)
+    if distribution is None:
+        distribution = [1.0]
+        for _ in range(diceRolled):
+            nextDistribution = [0.0]*(len(distribution) + faces)
+            for total, probability in enumerate(distribution):
+                if probability:
+                    for face in range(1, faces+1):
+                        nextDistribution[total+face] += probability/faces
+            distribution = nextDistribution
+        distribution = tuple(distribution)
+        _rollDistributions[key] = distribution
+    return distribution
+
+def expectedValue(distribution, values):
+    """
+    Dot product of a roll distribution with values[total], over the totals both cover
+    """
+    return sum(map(operator.mul, distribution, values))
+
+def rollProb(diceRolled, desiredValue, faces=DIE_FACES):
+    """
+    Probability of rolling desiredValue with diceRolled dice, read from the cached rollDistribution
+    """
+    if diceRolled < 1:
+        log.warning("Invalid number of dice %s - must be at least 1", diceRolled)
         return None
+    distribution = rollDistribution(diceRolled, faces)
+    if desiredValue < 0 or desiredValue >= len(distribution):
+        return 0.0
+    return distribution[desiredValue]
 
 if __name__ == '__main__':
   game = Game(2, 9)
   roll = game.rollDice(2)
   combos = game.validCombos(roll)
   game.playCombo(combos)
-  
+
@@ -0,0 +1,64 @@
+import json
+
+# Rates derived from a pair of (count, seconds or total) values when both were recorded
+RATES = {
+    "nodesPerSecond": ("nodesExpanded", "searchSeconds"),
+    "cacheHitRate": ("cacheHits", "cacheLookups"),
+    "bookHitRate": ("bookHits", "bookLookups"),
+    "roundsPerSecond": ("rounds", "simulateSeconds"),
+    "selectionNodesPerSecond": ("nodesVisited", "selectionSeconds"),
+    "updatesPerSecond": ("updates", "trainSeconds"),
+    "gamesPerSecond": ("games", "evaluateSeconds"),
+}
+
+
+class Metrics:
+    """
+    Counters and timers of a run. Totals add up when runs are merged (games, worker processes) and
+    peaks keep their largest value, so a whole experiment reduces to one Metrics.
+    """
+    def __init__(self, totals=None, peaks=None):
+        self.totals = dict(totals or {})
+        self.peaks = dict(peaks or {})
+
+    def add(self, name, value=1):
+        self.totals[name] = self.totals.get(name, 0) + value
+
+    def peak(self, name, value):
+        if value > self.peaks.get(name, value - 1):
+            self.peaks[name] = value
+
+    def merge(self, other):
+        for name, value in other.totals.items():
+            self.add(name, value)
+        for name, value in other.peaks.items():
+            self.peak(name, value)
+
+    def get(self, name, default=0):
+        return self.totals.get(name, self.peaks.get(name, default))
+
+    def rates(self):
+        rates = {}
+        for rate, (count, total) in RATES.items():
+            if count in self.totals and self.totals.get(total, 0) > 0:
+                rates[rate] = self.totals[count]/self.totals[total]
+        return rates
+
+    def toDict(self):
+        return dict(self.totals, **self.peaks, **self.rates())
+
+    def __str__(self):
+        return ", ".join("{}: {:.6g}".format(name, value) for name, value in self.toDict().items())
+
+
+def writeReport(path, report):
+    """
+    Writes a run report (a dict of JSON values, Metrics and RunningStats) as JSON
+    """
+    def encode(value):
+        if isinstance(value, Metrics):
+            return value.toDict()
+        # RunningStats
+        return {"count": value.count, "mean": value.mean, "stddev": value.stddev, "winRate": value.winRate}
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=encode)
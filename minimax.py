@@ -1,22 +1,119 @@
-from game import Game, rollProb
+from game import Game, expectedValue, tilesToMask
+from metrics import Metrics
+from collections import OrderedDict
 import math
 import copy
 import random
+import time
+
+class TranspositionCache:
+    """
+    Size-bounded transposition table with least-recently-used eviction. One cache can be shared by
+    several Minimax searches (and games), even of different rules, as entries are keyed on the rules and the
+    remaining search depth.
+    """
+    def __init__(self, maxSize=100000):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits/lookups if lookups else 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxSize": self.maxSize}
 
 class Minimax:
-    def __init__(self, players, maxDepth=100):
+    def __init__(self, players, maxDepth=100, cache=None, inPlace=True, book=None):
         self.players = players
         self.maxDepth = maxDepth
+        self.cache = cache
+        # book.DecisionBook: booked dice and tile decisions are returned without a search
+        self.book = book
+        # Search by shutting and reopening tiles on the given board instead of deep-copying it per move
+        self.inPlace = inPlace
+        self.nodesExpanded = 0
+        self.cacheHits = 0
+        self.cacheLookups = 0
+        self.bookHits = 0
+        self.bookLookups = 0
+        self.decisions = 0
+        self.searchSeconds = 0.0
 
     def rollDecision(self, boxState):
-        # If you have a 7,8,or 9 tiles left you have to roll two dice
-        if boxState.maxTileRemaining() > 6:
-            return 2
+        validDiceToRoll = boxState.diceOptions()
+        if len(validDiceToRoll) == 1:
+            return validDiceToRoll[0]
         else:
-            return self.__minimaxRoll__(boxState, 1)[0]
+            if self.book is not None:
+                dice = self.__bookGet__(self.book.getDice, boxState.mask)
+                if dice is not None:
+                    return dice
+            start = time.perf_counter()
+            dice = self.__minimaxRoll__(boxState, 1)[0]
+            self.__timeDecision__(start)
+            if self.book is not None:
+                self.book.putDice(boxState.mask, dice)
+            return dice
 
     def tileDecision(self, roll, boxState):
-        return self.__minimaxTiles__(roll, boxState, 1)[0]
+        if self.book is not None and len(boxState.validMasks(roll)) > 0:
+            combo = self.__bookGet__(self.book.getTiles, boxState.mask, roll)
+            if combo is not None:
+                return boxState.table.maskTiles[combo]
+        start = time.perf_counter()
+        tiles = self.__minimaxTiles__(roll, boxState, 1)[0]
+        self.__timeDecision__(start)
+        if self.book is not None and tiles is not None:
+            self.book.putTiles(boxState.mask, roll, tilesToMask(tiles))
+        return tiles
+
+    def __timeDecision__(self, start):
+        self.searchSeconds += time.perf_counter() - start
+        self.decisions += 1
+
+    def report(self):
+        """
+        Returns:
+            Metrics: Nodes expanded, cache and book lookups and hits of this search's own lookups, and search time
+        """
+        return Metrics({"decisions": self.decisions, "nodesExpanded": self.nodesExpanded, "cacheHits": self.cacheHits,
+                        "cacheLookups": self.cacheLookups, "bookHits": self.bookHits, "bookLookups": self.bookLookups,
+                        "searchSeconds": self.searchSeconds})
+
+    def __cacheGet__(self, key):
+        self.cacheLookups += 1
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cacheHits += 1
+        return cached
+
+    def __bookGet__(self, lookup, *key):
+        self.bookLookups += 1
+        decision = lookup(*key)
+        if decision is not None:
+            self.bookHits += 1
+        return decision
 
     def __minimaxRoll__(self, boxState, currentDepth):
         """
@@ -31,19 +128,28 @@ class Minimax:
             array: Returns array of length two, with the first value being the optimal number of dice rolled 
                    and the second being the expected value of rolling that many dice
         """
+        self.nodesExpanded += 1
         #If game is over, catch
         if boxState.getScore() == 0:
             return [None, 0]
+        if self.cache is not None:
+            key = (boxState.rules.key(), boxState.mask, "ROLL", None, self.maxDepth - currentDepth)
+            cached = self.__cacheGet__(key)
+            if cached is not None:
+                return cached
         values = []
-        # If you have a 7,8,or 9 tiles left you have to roll two dice. Otherwise can choose between 1 and 2
-        validDiceToRoll = [2] if boxState.maxTileRemaining() > 6 else [1,2]
+        rules = boxState.rules
+        validDiceToRoll = boxState.diceOptions()
+        # Value of every roll total any of the dice choices can make, each searched once
+        rollValues = [0]*(rules.faces*max(validDiceToRoll)+1)
+        for i in range(min(validDiceToRoll), len(rollValues)):
+            rollValues[i] = self.__minimaxTiles__(i, boxState, currentDepth)[1]
         for diceRolled in validDiceToRoll:
-            expectedValue = 0
-            for i in range(diceRolled, 6*diceRolled+1):
-                probability = rollProb(diceRolled, i)
-                expectedValue = expectedValue + probability*self.__minimaxTiles__(i, boxState, currentDepth)[1]
-            values.append([diceRolled,expectedValue])
-        return min(values, key = lambda value: value[1])
+            values.append([diceRolled, expectedValue(rules.distributions[diceRolled], rollValues)])
+        best = min(values, key = lambda value: value[1])
+        if self.cache is not None:
+            self.cache.put(key, best)
+        return best
 
     def __minimaxTiles__(self, rollValue, boxState, currentDepth):
         """
@@ -55,14 +161,24 @@ class Minimax:
             boxState (Game): Current state of box and which tiles can be shut
             currentDepth (int): Current depth of search, used with self.maxDepth to truncate search
 
+        Results are stored in self.cache (when given) keyed on the rules, tiles, roll and remaining depth
+
         Returns:
             array: Returns array of length two, with the first value being the best set to choose and the second being the best case value
         """
+        self.nodesExpanded += 1
+        if self.inPlace:
+            return self.__minimaxTilesInPlace__(rollValue, boxState, currentDepth)
         validCombos = boxState.validCombos(rollValue)
         # If no valid combos, game is over
         if len(validCombos) == 0:
             return [None, boxState.getScore()]
         else:
+            if self.cache is not None:
+                key = (boxState.rules.key(), boxState.mask, "TILES", rollValue, self.maxDepth - currentDepth)
+                cached = self.__cacheGet__(key)
+                if cached is not None:
+                    return cached
             values = []
             for set in validCombos:
                 nextState = copy.deepcopy(boxState)
@@ -72,7 +188,50 @@ class Minimax:
                     values.append([set, nextState.getScore()])
                 else:
                     values.append([set, self.__minimaxRoll__(nextState, currentDepth+1)[1]])
-            return min(values, key = lambda value: value[1])
+            best = min(values, key = lambda value: value[1])
+            if self.cache is not None:
+                self.cache.put(key, best)
+            return best
+
+    def __minimaxTilesInPlace__(self, rollValue, boxState, currentDepth):
+        """
+        Same search as __minimaxTiles__, but each combo is shut directly on boxState's board mask,
+        searched, and then reopened, so no Game is copied along the way
+
+        Returns:
+            array: Returns array of length two, with the first value being the best set to choose and the second being the best case value
+        """
+        table = boxState.table
+        maskScore = boxState.rules.maskScore
+        mask = boxState.mask
+        combos = table.legalCombos(mask, rollValue)
+        # If no valid combos, game is over
+        if len(combos) == 0:
+            return [None, maskScore[mask]]
+        if self.cache is not None:
+            key = (boxState.rules.key(), mask, "TILES", rollValue, self.maxDepth - currentDepth)
+            cached = self.__cacheGet__(key)
+            if cached is not None:
+                return cached
+        bestCombo = None
+        bestValue = 0
+        for combo in combos:
+            # Make the move, score or recurse, then unmake it, even if the search raises
+            boxState.mask = mask ^ combo
+            try:
+                if currentDepth == self.maxDepth:
+                    value = maskScore[boxState.mask]
+                else:
+                    value = self.__minimaxRoll__(boxState, currentDepth+1)[1]
+            finally:
+                boxState.mask = mask
+            if bestCombo is None or value < bestValue:
+                bestCombo = combo
+                bestValue = value
+        best = [table.maskTiles[bestCombo], bestValue]
+        if self.cache is not None:
+            self.cache.put(key, best)
+        return best
 
 if __name__ == '__main__':
     game = Game(2, 9)
@@ -1,7 +1,78 @@
-from game import Game, rollProb
+from game import Game, tilesToMask
+from rollout import BatchRollout
+from metrics import Metrics
+from multiprocessing import Pool
+import logging
 import math
 import copy
 import random
+import time
+
+log = logging.getLogger(__name__)
+
+# Plies below the root whose statistics root-parallel workers send back: dice, roll and next board
+MERGED_PLIES = 3
+
+
+def simulateBoard(rules, mask, dice=None, roll=None):
+    """
+    Plays one random game from a board mask with the same policy as MonteCarlo.__simulateRound__
+
+    Parameters:
+        rules (Rules): Rules of the game
+        mask (int): Tile mask of the starting board
+        dice (int): If given, the game starts with this many dice already chosen
+        roll (int): If given, the game starts with this roll already thrown
+
+    Returns:
+        int: Final score of the game
+    """
+    table = rules.table
+    while True:
+        if roll is None:
+            if dice is None:
+                #Check if all tiles shut - if so return optimal score of 0
+                if mask == 0:
+                    return 0
+                #Otherwise, decide dice to roll (random among the dice the board allows)
+                options = rules.maskDice[mask]
+                dice = options[0] if len(options) == 1 else random.randint(options[0], options[-1])
+            #Throw every die, so roll totals follow the dice distribution as in Game.rollDice
+            roll = 0
+            for i in range(dice):
+                roll = roll + random.randint(1, rules.faces)
+        #Check valid combos - if none, game is over and return score. Otherwise, make random move from valid combos
+        nextMasks = table.legalNextMasks(mask, roll)
+        if len(nextMasks) == 0:
+            return rules.maskScore[mask]
+        mask = random.choice(nextMasks)
+        dice = None
+        roll = None
+
+
+def simulateRootParallel(players, rules, mask, dice, maxScore, rounds, c, rollouts, seed):
+    """
+    Worker of MonteCarlo's root-parallel search. Grows an independent tree from the root board
+    (with the dice already chosen when given) and returns the statistics of its nodes down to MERGED_PLIES
+    below the root, so the merged tree has searched statistics for the dice, roll and tile choices that follow.
+
+    Returns:
+        array: List of [path of node keys from the root, games, average] for every node, parents before children
+    """
+    random.seed(seed)
+    mc = MonteCarlo(Game.fromMask(players, rules.numTiles, mask, rules), rounds)
+    mc.rootNode.maxScore = maxScore
+    if dice is not None:
+        mc.updateDiceChoice(dice)
+    mc.simulate(rounds, c, rollouts)
+    stats = []
+    nodes = [(child, (child.key(),)) for child in reversed(mc.rootNode.children)]
+    while nodes:
+        node, path = nodes.pop()
+        stats.append([path, node.games, node.average])
+        if len(path) < MERGED_PLIES:
+            nodes.extend((child, path + (child.key(),)) for child in reversed(node.children))
+    return stats
 
 
 class SimulationNode:
@@ -17,6 +88,19 @@ class SimulationNode:
     def hasChildren(self):
         return len(self.children) > 0
 
+    def key(self):
+        """
+        What tells this node apart from its siblings: the dice, roll or board mask it was reached by
+        """
+        pass
+
+    def childByKey(self, key):
+        self.generateChildren()
+        for child in self.children:
+            if child.key() == key:
+                return child
+        return None
+
     def getExplorationValue(self, c):
         #If node hasn't been simulated, we want to simulate. Also addressed division by 0 issue
         if self.games == 0:
@@ -50,27 +134,14 @@ class RoundStartNode(SimulationNode):
         else:
             self.set = game.tiles
 
-    def __deepcopy__(self, memodict={}):
-        copy_node = RoundStartNode(self.state, self.parent)
-        copy_node.state = copy.deepcopy(self.state)
-        copy_node.parent = self.parent
-        copy_node.nodeType = self.nodeType
-        copy_node.maxScore = self.maxScore
-        copy_node.games = self.games
-        copy_node.average = self.average
-        copy_node.set = self.set
-
-        for child in self.children:
-            child_copy = child.__deepcopy__(self, None)
-            copy_node.children.append(child_copy)
-
-        return copy_node
+    def key(self):
+        return self.state.mask
 
     def generateChildren(self):
         if len(self.children) == 0:
-            self.children.append(PreRollNode(self.state, self, 2))
-            if self.state.maxTileRemaining() <= 6:
-                self.children.append(PreRollNode(self.state, self, 1))
+            # Most dice first, then the fewer dice allowed once no tile above the threshold is open
+            for dice in reversed(self.state.diceOptions()):
+                self.children.append(PreRollNode(self.state, self, dice))
 
     def chooseChild(self, c):
         #Chose child based on exploration value
@@ -83,32 +154,19 @@ class PreRollNode(SimulationNode):
         SimulationNode.__init__(self, game, parent, "PRE_ROLL_NODE")
         self.dice = diceToRoll
 
-    def __deepcopy__(self, parent, memodict={}):
-        copy_node = PreRollNode(self.state, parent, self.dice)
-        copy_node.state = copy.deepcopy(self.state)
-        copy_node.parent = self.parent
-        copy_node.nodeType = self.nodeType
-        copy_node.maxScore = self.maxScore
-        copy_node.games = self.games
-        copy_node.average = self.average
-        copy_node.dice = self.dice
-
-        for child in self.children:
-            child_copy = child.__deepcopy__(self, None)
-            copy_node.children.append(child_copy)
-
-        return copy_node
+    def key(self):
+        return self.dice
 
     def generateChildren(self):
         if len(self.children) == 0:
-            for i in range(self.dice, 6*self.dice+1):
+            for i in range(self.dice, self.state.rules.faces*self.dice+1):
                 self.children.append(PostRollNode(self.state, self, i))
 
     def chooseChild(self, c):
         #Chose randomly based on die roll to simulate realistic scenario
         rollValue = 0
         for i in range(self.dice):
-            rollValue = rollValue + random.randint(1,6)
+            rollValue = rollValue + random.randint(1, self.state.rules.faces)
         for child in self.children:
             if child.roll == rollValue:
                 return child
@@ -120,21 +178,8 @@ class PostRollNode(SimulationNode):
         SimulationNode.__init__(self, game, parent, "POST_ROLL_NODE")
         self.roll = rollValue
 
-    def __deepcopy__(self, parent, memodict={}):
-        copy_node = PostRollNode(self.state, self.parent, self.roll)
-        copy_node.state = copy.deepcopy(self.state)
-        copy_node.parent = self.parent
-        copy_node.nodeType = self.nodeType
-        copy_node.maxScore = self.maxScore
-        copy_node.games = self.games
-        copy_node.average = self.average
-        copy_node.roll = self.roll
-
-        for child in self.children:
-            child_copy = child.__deepcopy__(self, None)
-            copy_node.children.append(child_copy)
-
-        return copy_node
+    def key(self):
+        return self.roll
 
     def generateChildren(self):
         if len(self.children) == 0:
@@ -156,69 +201,201 @@ class PostRollNode(SimulationNode):
 
 
 class MonteCarlo:
-    def __init__(self, game, simulationRounds):
+    def __init__(self, game, simulationRounds, workers=1, book=None):
         self.maxRounds = simulationRounds
         self.state = game
         self.rootNode = RoundStartNode(game, None)
+        self.batchRollout = None
+        # With workers > 1, simulate grows that many root-parallel trees in a process pool
+        self.workers = workers
+        self.pool = None
+        self.metrics = Metrics()
+        # book.DecisionBook: booked dice and tiles are played without a search, and simulate is skipped on a booked position
+        self.book = book
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def __updateRoot__(self, newRoot):
+        """
+        Advances the root to one of its children, keeping the statistics already gathered under it.
+        The new root is detached from the old tree so backpropagation stops at it and the rest of the
+        old tree can be freed.
+        """
         self.rootNode = newRoot
+        self.rootNode.parent = None
         self.state = newRoot.state
 
     def __simulateRound__(self, startNode):
-        currentNode = copy.deepcopy(startNode)
-        while currentNode:
-            if currentNode.nodeType == "ROUND_START_NODE":
-                #Check if all tiles shut - if so return optimal score of 0
-                if currentNode.state.getScore() == 0:
-                    return 0
-                #Otherwise, decide dice to roll (must be 2 if 7,8, or 9 tile remaining, random otherwise)
-                elif currentNode.state.maxTileRemaining() > 6:
-                    currentNode = PreRollNode(currentNode.state, currentNode, 2)
-                else:
-                    diceToRoll = random.randint(1,2)
-                    currentNode = PreRollNode(currentNode.state, currentNode, diceToRoll)
-            elif currentNode.nodeType == "PRE_ROLL_NODE":
-                #Do a random roll
-                diceRoll = random.randint(currentNode.dice, 6*currentNode.dice)
-                currentNode = PostRollNode(currentNode.state, currentNode, diceRoll)
-            elif currentNode.nodeType == "POST_ROLL_NODE":
-                validCombos = currentNode.state.validCombos(currentNode.roll)
-                #Check valid combos - if none, game is over and return score. Otherwise, make random move from valid combos
-                if len(validCombos) == 0:
-                    return currentNode.state.getScore()
-                else:
-                    nextCombo = random.choice(validCombos)
-                    currentNode.state.playCombo(nextCombo)
-                    currentNode = RoundStartNode(currentNode.state, currentNode)
-            else:
-                #This shouldn't happen, but return board score otherwise
-                return currentNode.state.getScore()
+        """
+        Plays one random game from startNode. The game runs on a copy of the node's board mask,
+        so no tree nodes are copied or created and the cost does not depend on the size of the tree.
+        """
+        if startNode.nodeType == "PRE_ROLL_NODE":
+            return simulateBoard(startNode.state.rules, startNode.state.mask, dice=startNode.dice)
+        elif startNode.nodeType == "POST_ROLL_NODE":
+            return simulateBoard(startNode.state.rules, startNode.state.mask, roll=startNode.roll)
+        return simulateBoard(startNode.state.rules, startNode.state.mask)
+
+    def __simulateBatch__(self, startNode, rollouts):
+        """
+        Plays rollouts random games from startNode at once with the vectorized BatchRollout engine
+
+        Returns:
+            float: Mean final score of the games
+        """
+        if self.batchRollout is None:
+            # Seeded from the random module, so seeded games with batched rollouts replay the same
+            self.batchRollout = BatchRollout(startNode.state.rules, random.getrandbits(64))
+        if startNode.nodeType == "PRE_ROLL_NODE":
+            scores = self.batchRollout.rollouts(startNode.state.mask, rollouts, dice=startNode.dice)
+        elif startNode.nodeType == "POST_ROLL_NODE":
+            scores = self.batchRollout.rollouts(startNode.state.mask, rollouts, roll=startNode.roll)
+        else:
+            scores = self.batchRollout.rollouts(startNode.state.mask, rollouts)
+        return float(scores.mean())
 
-    def __updateScores__(self, node, score):
+    def __updateScores__(self, node, score, games=1):
         while node:
-            node.average = (node.average*node.games+score)/(node.games+1)
-            node.games = node.games + 1
+            node.average = (node.average*node.games+score*games)/(node.games+games)
+            node.games = node.games + games
             node = node.parent
 
-    def simulate(self, rounds, c):
-        print("Simulating {} rounds...".format(rounds))
+    def __simulateParallel__(self, rounds, c, rollouts):
+        """
+        Root parallelization: splits rounds over self.workers independent trees grown in worker processes
+        from the current root, then merges the visit counts and averages of their top MERGED_PLIES plies into
+        this tree, so the tile choice after the roll is made from searched statistics as well
+        """
+        if self.pool is None:
+            self.pool = Pool(self.workers)
+        root = self.rootNode
+        dice = root.dice if root.nodeType == "PRE_ROLL_NODE" else None
+        tasks = []
+        for worker in range(self.workers):
+            workerRounds = rounds//self.workers + (1 if worker < rounds % self.workers else 0)
+            tasks.append((self.state.players, self.state.rules, self.state.mask, dice, root.maxScore,
+                          workerRounds, c, rollouts, random.getrandbits(32)))
+        for workerStats in self.pool.starmap(simulateRootParallel, tasks):
+            nodes = {(): root}
+            for path, games, average in workerStats:
+                parent = nodes.get(path[:-1])
+                if games == 0 or parent is None:
+                    continue
+                node = parent.childByKey(path[-1])
+                nodes[path] = node
+                node.average = (node.average*node.games+average*games)/(node.games+games)
+                node.games = node.games + games
+                if len(path) == 1:
+                    root.average = (root.average*root.games+average*games)/(root.games+games)
+                    root.games = root.games + games
+
+    def simulate(self, rounds, c, rollouts=1):
+        """
+        Runs rounds of selection, expansion, rollout and backpropagation from the root.
+        With rollouts > 1 each leaf is evaluated by that many vectorized rollouts and their mean is backed up
+        (leaf parallelization), and with self.workers > 1 the rounds are split over root-parallel trees.
+        """
+        if self.__booked__():
+            log.debug("Booked position, skipping simulation")
+            self.metrics.add("bookSkips")
+            return
+        log.debug("Simulating %d rounds...", rounds)
+        start = time.perf_counter()
+        self.metrics.add("rounds", rounds)
+        if self.workers > 1:
+            self.__simulateParallel__(rounds, c, rollouts)
+            self.metrics.add("simulateSeconds", time.perf_counter() - start)
+            self.metrics.peak("treeSize", self.treeSize())
+            return
+        clock = time.perf_counter
+        selection = expansion = rollout = backprop = 0.0
+        visited = 0
         for i in range(rounds):
             #print("Root count: {} av: {}".format(self.rootNode.games, self.rootNode.average))
+            selectStart = clock()
             currentNode = self.rootNode
             #Use exploration value to search for optimal leaf
             while currentNode.hasChildren():
                 currentNode = currentNode.chooseChild(c)
+                visited += 1
             ##Once leaf found, do simulation and propogate score if node isn't a win
             if currentNode.state.getScore() == 0:
+                selection += clock() - selectStart
                 continue
+            expandStart = clock()
             currentNode.generateChildren()
             """for subNode in currentNode.children:
                 simulatedScore = self.__simulateRound__(subNode)
                 self.__updateScores__(subNode, simulatedScore)"""
             childToSimulate = currentNode.chooseChild(c)
-            simulatedScore = self.__simulateRound__(childToSimulate)
-            self.__updateScores__(childToSimulate, simulatedScore)
+            rolloutStart = clock()
+            if rollouts > 1:
+                simulatedScore = self.__simulateBatch__(childToSimulate, rollouts)
+                games = rollouts
+            else:
+                simulatedScore = self.__simulateRound__(childToSimulate)
+                games = 1
+            backpropStart = clock()
+            self.__updateScores__(childToSimulate, simulatedScore, games)
+            backpropEnd = clock()
+            selection += expandStart - selectStart
+            expansion += rolloutStart - expandStart
+            rollout += backpropStart - rolloutStart
+            backprop += backpropEnd - backpropStart
+        for name, value in [("selectionSeconds", selection), ("expansionSeconds", expansion), ("rolloutSeconds", rollout),
+                            ("backpropSeconds", backprop), ("nodesVisited", visited), ("simulateSeconds", time.perf_counter() - start)]:
+            self.metrics.add(name, value)
+        # Measured here, as the tree is pruned to the chosen moves' subtrees once decisions are made
+        self.metrics.peak("treeSize", self.treeSize())
+
+    def treeSize(self):
+        size = 0
+        nodes = [self.rootNode]
+        while nodes:
+            node = nodes.pop()
+            size += 1
+            nodes.extend(node.children)
+        return size
+
+    def report(self):
+        """
+        Returns:
+            Metrics: Counters and phase timers of every simulate call, with the largest tree size after one
+        """
+        metrics = Metrics()
+        metrics.merge(self.metrics)
+        return metrics
+
+    def __booked__(self):
+        """
+        Whether the book holds the dice choice of the root board and the tile choice of every roll of those dice,
+        so the coming decisions need no search
+        """
+        if self.book is None or self.rootNode.nodeType != "ROUND_START_NODE":
+            return False
+        state = self.rootNode.state
+        options = state.diceOptions()
+        dice = options[0] if len(options) == 1 else self.book.peekDice(state.mask)
+        if dice is None:
+            return False
+        for roll in range(dice, state.rules.faces*dice+1):
+            if len(state.validMasks(roll)) > 0 and not self.book.hasTiles(state.mask, roll):
+                return False
+        return True
+
+    def __bookGet__(self, lookup, *key):
+        self.metrics.add("bookLookups")
+        decision = lookup(*key)
+        if decision is not None:
+            self.metrics.add("bookHits")
+        return decision
+
+    def rootGames(self):
+        return self.rootNode.games
 
     def updateDiceChoice(self, diceToRoll):
         if self.rootNode.nodeType == "ROUND_START_NODE":
@@ -227,10 +404,11 @@ class MonteCarlo:
                     self.__updateRoot__(subNode)
                     return
             #If choice was never expanded, create child nodes and update
-            self.rootNode.generateChildren()
-            updateDiceChoice(newState)
+            if len(self.rootNode.children) == 0:
+                self.rootNode.generateChildren()
+                self.updateDiceChoice(diceToRoll)
         else:
-            print("Root is not RoundStartNode to handle dice choice")
+            log.warning("Root is not RoundStartNode to handle dice choice")
 
     
     def updateRollValue(self, rollValue):
@@ -240,50 +418,77 @@ class MonteCarlo:
                     self.__updateRoot__(subNode)
                     return
             #If choice was never expanded, create child nodes and update
-            self.rootNode.generateChildren()
-            updateRollValue(newState)
+            if len(self.rootNode.children) == 0:
+                self.rootNode.generateChildren()
+                self.updateRollValue(rollValue)
         else:
-            print("Root is not PreRollNode to handle roll")
+            log.warning("Root is not PreRollNode to handle roll")
     
     def updateTileChoice(self, newState):
         if self.rootNode.nodeType == "POST_ROLL_NODE":
             for subNode in self.rootNode.children:
-                if subNode.state.tiles == subNode.state.tiles:
+                if subNode.state.mask == newState.mask:
                     self.__updateRoot__(subNode)
+                    return
             #If choice was never expanded, create child nodes and update
-            self.rootNode.generateChildren()
-            updateTileChoice(newState)
+            if len(self.rootNode.children) == 0:
+                self.rootNode.generateChildren()
+                self.updateTileChoice(newState)
         else:
-            print("Root is not PostRollNode to handle tile choice")
+            log.warning("Root is not PostRollNode to handle tile choice")
 
     def rollDecision(self):
         if self.rootNode.nodeType != "ROUND_START_NODE":
-            print("State is not prepared for a roll")
+            log.warning("State is not prepared for a roll")
         else:
+            state = self.rootNode.state
+            options = state.diceOptions()
+            # A forced number of dice needs no search, and the root may not be expanded when its position is booked
+            if len(options) == 1:
+                self.updateDiceChoice(options[0])
+                return options[0]
+            if self.book is not None:
+                dice = self.__bookGet__(self.book.getDice, state.mask)
+                if dice is not None:
+                    self.updateDiceChoice(dice)
+                    return dice
             choice = min(self.rootNode.children, key = lambda child: child.average)
             self.__updateRoot__(choice)
+            if self.book is not None:
+                self.book.putDice(state.mask, choice.dice)
             return choice.dice
     
     def tileDecision(self, roll):
         if self.rootNode.nodeType != "PRE_ROLL_NODE":
-            print("State is not prepared for a tile choice")
+            log.warning("State is not prepared for a tile choice")
         else:
             #Adjust to roll, then make choice
             self.updateRollValue(roll)
-            if len(self.rootNode.state.validCombos(roll)) == 0:
+            state = self.rootNode.state
+            if len(state.validCombos(roll)) == 0:
                 return None
-            elif len(self.rootNode.children) == 0:
-                print(self.rootNode.state.tiles)
-                print(self.rootNode.children)
-                self.rootNode.generateChildren()
-                choice = random.choice(self.rootNode.children)
-                self.__updateRoot__(choice)
-                return choice.set
-            else:
-                choice = min(self.rootNode.children, key = lambda child: child.average)
-                self.__updateRoot__(choice)
-                return choice.set
-            
+            if self.book is not None:
+                combo = self.__bookGet__(self.book.getTiles, state.mask, roll)
+                if combo is not None:
+                    self.updateTileChoice(Game.fromMask(state.players, state.numTiles, state.mask ^ combo, state.rules))
+                    return state.table.maskTiles[combo]
+            # Only choices made from searched statistics go into the book
+            searched = len(self.rootNode.children) > 0
+            choice = self.__searchedTileChoice__(roll)
+            if self.book is not None and searched:
+                self.book.putTiles(state.mask, roll, tilesToMask(choice))
+            return choice
+
+    def __searchedTileChoice__(self, roll):
+        if len(self.rootNode.children) == 0:
+            log.debug("No expanded tile choice for roll %d on %s", roll, self.rootNode.state.tiles)
+            self.rootNode.generateChildren()
+            choice = random.choice(self.rootNode.children)
+        else:
+            choice = min(self.rootNode.children, key = lambda child: child.average)
+        self.__updateRoot__(choice)
+        return choice.set
+
 
 if __name__ == '__main__':
     mc = MonteCarlo(Game(2, 9), 2000)
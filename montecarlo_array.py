@@ -0,0 +1,261 @@
+from game import Game
+from montecarlo import simulateBoard
+from rollout import BatchRollout
+from metrics import Metrics
+from array import array
+import logging
+import math
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+ROUND_START_NODE = 0
+PRE_ROLL_NODE = 1
+POST_ROLL_NODE = 2
+
+# Typecode of every per-node field of the tree store
+NODE_FIELDS = {
+    "kind": "b",        # ROUND_START_NODE, PRE_ROLL_NODE or POST_ROLL_NODE
+    "board": "H",       # Tile mask of the node's board
+    "choice": "b",      # Dice rolled for a PRE_ROLL_NODE, roll value for a POST_ROLL_NODE
+    "parent": "i",      # Index of the parent node, -1 for the first root
+    "firstChild": "i",  # Index of the first child, children are stored next to each other
+    "childCount": "h",
+    "games": "q",
+    "average": "d",
+}
+
+def bytesPerNode():
+    return sum(array(typecode).itemsize for typecode in NODE_FIELDS.values())
+
+
+class ArrayMonteCarlo:
+    """
+    Monte Carlo tree search over the same round start / pre roll / post roll tree as montecarlo.MonteCarlo,
+    with node statistics, parents, child ranges and node kinds kept in preallocated typed arrays (one slot
+    per node) rather than one Python object per node. Boards are stored as tile masks.
+    """
+    def __init__(self, game, simulationRounds, capacity=1024):
+        self.maxRounds = simulationRounds
+        self.state = game
+        self.rules = game.rules
+        self.table = game.table
+        self.maxScore = game.getScore()
+        self.size = 0
+        self.capacity = 0
+        for name, typecode in NODE_FIELDS.items():
+            setattr(self, name, array(typecode))
+        self.__grow__(capacity)
+        self.rootNode = self.__addNode__(ROUND_START_NODE, game.mask, 0, -1)
+        self.batchRollout = None
+        self.metrics = Metrics()
+
+    def __grow__(self, capacity):
+        extra = capacity - self.capacity
+        for name, typecode in NODE_FIELDS.items():
+            getattr(self, name).frombytes(bytes(extra*array(typecode).itemsize))
+        self.capacity = capacity
+
+    def __addNode__(self, kind, board, choice, parent):
+        if self.size == self.capacity:
+            self.__grow__(2*self.capacity)
+        node = self.size
+        self.kind[node] = kind
+        self.board[node] = board
+        self.choice[node] = choice
+        self.parent[node] = parent
+        self.firstChild[node] = -1
+        self.childCount[node] = 0
+        self.games[node] = 0
+        self.average[node] = 0
+        self.size += 1
+        return node
+
+    def treeSize(self):
+        return self.size
+
+    def memoryBytes(self):
+        """
+        Bytes allocated by the tree store, including unused preallocated slots
+        """
+        return sum(getattr(self, name).buffer_info()[1]*getattr(self, name).itemsize for name in NODE_FIELDS)
+
+    def children(self, node):
+        first = self.firstChild[node]
+        return range(first, first + self.childCount[node])
+
+    def generateChildren(self, node):
+        if self.childCount[node] > 0:
+            return
+        board = self.board[node]
+        kind = self.kind[node]
+        first = self.size
+        if kind == ROUND_START_NODE:
+            for dice in reversed(self.rules.maskDice[board]):
+                self.__addNode__(PRE_ROLL_NODE, board, dice, node)
+        elif kind == PRE_ROLL_NODE:
+            dice = self.choice[node]
+            for i in range(dice, self.rules.faces*dice+1):
+                self.__addNode__(POST_ROLL_NODE, board, i, node)
+        else:
+            for nextBoard in self.table.legalNextMasks(board, self.choice[node]):
+                self.__addNode__(ROUND_START_NODE, nextBoard, 0, node)
+        count = self.size - first
+        if count > 0:
+            self.firstChild[node] = first
+            self.childCount[node] = count
+
+    def getExplorationValue(self, node, c):
+        #If node hasn't been simulated, we want to simulate. Also addressed division by 0 issue
+        games = self.games[node]
+        if games == 0:
+            return 1000000
+        else:
+            return (self.maxScore - self.average[node])/self.maxScore + c * math.sqrt(math.log(self.games[self.parent[node]])/games)
+
+    def chooseChild(self, node, c):
+        kind = self.kind[node]
+        if kind == PRE_ROLL_NODE:
+            #Chose randomly based on die roll to simulate realistic scenario
+            dice = self.choice[node]
+            rollValue = 0
+            for i in range(dice):
+                rollValue = rollValue + random.randint(1, self.rules.faces)
+            return self.firstChild[node] + rollValue - dice
+        if kind == POST_ROLL_NODE:
+            self.generateChildren(node)
+            #If no children generated, this is terminal state
+            if self.childCount[node] == 0:
+                return node
+        #Otherwise chose child based on exploration value
+        return max(self.children(node), key = lambda child: self.getExplorationValue(child, c))
+
+    def __simulateRound__(self, node):
+        kind = self.kind[node]
+        if kind == PRE_ROLL_NODE:
+            return simulateBoard(self.rules, self.board[node], dice=self.choice[node])
+        elif kind == POST_ROLL_NODE:
+            return simulateBoard(self.rules, self.board[node], roll=self.choice[node])
+        return simulateBoard(self.rules, self.board[node])
+
+    def __simulateBatch__(self, node, rollouts):
+        if self.batchRollout is None:
+            self.batchRollout = BatchRollout(self.rules, random.getrandbits(64))
+        kind = self.kind[node]
+        if kind == PRE_ROLL_NODE:
+            scores = self.batchRollout.rollouts(self.board[node], rollouts, dice=self.choice[node])
+        elif kind == POST_ROLL_NODE:
+            scores = self.batchRollout.rollouts(self.board[node], rollouts, roll=self.choice[node])
+        else:
+            scores = self.batchRollout.rollouts(self.board[node], rollouts)
+        return float(scores.mean())
+
+    def __updateScores__(self, node, score, games=1):
+        while node >= 0:
+            self.average[node] = (self.average[node]*self.games[node]+score*games)/(self.games[node]+games)
+            self.games[node] = self.games[node] + games
+            node = self.parent[node]
+
+    def __updateRoot__(self, node):
+        # Detach the new root so backpropagation stops at it, as MonteCarlo does
+        self.rootNode = node
+        self.parent[node] = -1
+        self.state = Game.fromMask(self.state.players, self.table.numTiles, self.board[node], self.rules)
+
+    def simulate(self, rounds, c, rollouts=1):
+        log.debug("Simulating %d rounds...", rounds)
+        start = time.perf_counter()
+        clock = time.perf_counter
+        selection = expansion = rollout = backprop = 0.0
+        visited = 0
+        for i in range(rounds):
+            selectStart = clock()
+            node = self.rootNode
+            #Use exploration value to search for optimal leaf
+            while self.childCount[node] > 0:
+                node = self.chooseChild(node, c)
+                visited += 1
+            ##Once leaf found, do simulation and propogate score if node isn't a win
+            if self.rules.maskScore[self.board[node]] == 0:
+                selection += clock() - selectStart
+                continue
+            expandStart = clock()
+            self.generateChildren(node)
+            childToSimulate = self.chooseChild(node, c)
+            rolloutStart = clock()
+            if rollouts > 1:
+                simulatedScore = self.__simulateBatch__(childToSimulate, rollouts)
+                games = rollouts
+            else:
+                simulatedScore = self.__simulateRound__(childToSimulate)
+                games = 1
+            backpropStart = clock()
+            self.__updateScores__(childToSimulate, simulatedScore, games)
+            backpropEnd = clock()
+            selection += expandStart - selectStart
+            expansion += rolloutStart - expandStart
+            rollout += backpropStart - rolloutStart
+            backprop += backpropEnd - backpropStart
+        for name, value in [("rounds", rounds), ("selectionSeconds", selection), ("expansionSeconds", expansion), ("rolloutSeconds", rollout),
+                            ("backpropSeconds", backprop), ("nodesVisited", visited), ("simulateSeconds", time.perf_counter() - start)]:
+            self.metrics.add(name, value)
+
+    def report(self):
+        """
+        Returns:
+            Metrics: Counters and phase timers of every simulate call, with the tree size and store bytes
+        """
+        metrics = Metrics()
+        metrics.merge(self.metrics)
+        metrics.peak("treeSize", self.treeSize())
+        metrics.peak("treeBytes", self.memoryBytes())
+        return metrics
+
+    def rootGames(self):
+        return self.games[self.rootNode]
+
+    def rollDecision(self):
+        if self.kind[self.rootNode] != ROUND_START_NODE:
+            log.warning("State is not prepared for a roll")
+        else:
+            choice = min(self.children(self.rootNode), key = lambda child: self.average[child])
+            self.__updateRoot__(choice)
+            return self.choice[choice]
+
+    def tileDecision(self, roll):
+        if self.kind[self.rootNode] != PRE_ROLL_NODE:
+            log.warning("State is not prepared for a tile choice")
+        else:
+            #Adjust to roll, then make choice
+            self.generateChildren(self.rootNode)
+            self.__updateRoot__(self.firstChild[self.rootNode] + roll - self.choice[self.rootNode])
+            if len(self.state.validCombos(roll)) == 0:
+                return None
+            elif self.childCount[self.rootNode] == 0:
+                self.generateChildren(self.rootNode)
+                choice = random.choice(self.children(self.rootNode))
+            else:
+                choice = min(self.children(self.rootNode), key = lambda child: self.average[child])
+            combo = self.board[self.rootNode] ^ self.board[choice]
+            self.__updateRoot__(choice)
+            return self.table.maskTiles[combo]
+
+
+if __name__ == '__main__':
+    mc = ArrayMonteCarlo(Game(2, 9), 2000)
+    c = 1
+    mc.simulate(200, c)
+    while(mc.state.getScore() > 0):
+        print("Score: {}\t Tiles:{}".format(mc.state.getScore(), mc.state.tiles))
+        mc.simulate(200, c)
+        diceUsed = mc.rollDecision()
+        roll = mc.state.rollDice(diceUsed)
+        tilesToShut = mc.tileDecision(roll)
+        print("Roll: {}\t Shutting: {}".format(roll, tilesToShut))
+        #Adjust c to less exploration and more exploitation as we get deeper
+        c = c/2
+        if tilesToShut == None:
+            break
+    print("Score: {}\t Tiles:{}".format(mc.state.getScore(), mc.state.tiles))
+    print("Tree size: {} nodes, {} bytes".format(mc.treeSize(), mc.memoryBytes()))
@@ -0,0 +1,241 @@
+from game import Game
+from montecarlo import simulateBoard
+from rollout import BatchRollout
+from metrics import Metrics
+import logging
+import math
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+
+class BoardStats:
+    """
+    Statistics of a board (tile mask) shared by every path that reaches it, with the visit count and
+    average score of each dice choice made from it
+    """
+    __slots__ = ("games", "average", "edgeGames", "edgeAverage")
+
+    def __init__(self):
+        self.games = 0
+        self.average = 0
+        self.edgeGames = {}
+        self.edgeAverage = {}
+
+    def update(self, edge, score, games):
+        self.average = (self.average*self.games+score*games)/(self.games+games)
+        self.games = self.games + games
+        if edge is not None:
+            edgeGames = self.edgeGames.get(edge, 0)
+            edgeAverage = self.edgeAverage.get(edge, 0)
+            self.edgeAverage[edge] = (edgeAverage*edgeGames+score*games)/(edgeGames+games)
+            self.edgeGames[edge] = edgeGames + games
+
+
+class RollStats(BoardStats):
+    """
+    Statistics of a (board, roll) pair, with the visit count and average score of each next board chosen from it
+    """
+    __slots__ = ()
+
+
+class TranspositionMonteCarlo:
+    """
+    Monte Carlo tree search over a DAG: boards and (board, roll) pairs are stored once in hash tables keyed
+    by tile mask, so statistics pool across every roll/combo path that transposes into the same tiles.
+
+    Tile choices use the UCT variant for DAGs that takes the mean from the shared statistics of the next
+    board but the exploration term from the visit count of the edge being followed, so a board reached
+    often through other paths is still explored from this one. Dice choices depend only on the board and
+    use their edge statistics directly.
+    """
+    def __init__(self, game, simulationRounds, maxNodes=200000):
+        self.maxRounds = simulationRounds
+        self.maxNodes = maxNodes
+        self.state = game
+        self.rules = game.rules
+        self.table = game.table
+        self.maxScore = game.getScore()
+        self.boards = {}
+        self.rolls = {}
+        # Dice already chosen for the current board, None at the start of a round
+        self.dice = None
+        self.batchRollout = None
+        self.metrics = Metrics()
+        self.__addBoard__(game.mask)
+
+    def treeSize(self):
+        return len(self.boards) + len(self.rolls)
+
+    def __full__(self):
+        return self.treeSize() >= self.maxNodes
+
+    def __addBoard__(self, mask):
+        stats = BoardStats()
+        self.boards[mask] = stats
+        return stats
+
+    def __validDice__(self, mask):
+        # Most dice first
+        return self.rules.maskDice[mask][::-1]
+
+    def __explorationValue__(self, average, games, parentGames, c):
+        return (self.maxScore - average)/self.maxScore + c * math.sqrt(math.log(parentGames)/games)
+
+    def __chooseDice__(self, stats, mask, c):
+        options = self.__validDice__(mask)
+        for dice in options:
+            if stats.edgeGames.get(dice, 0) == 0:
+                return dice
+        return max(options, key = lambda dice: self.__explorationValue__(stats.edgeAverage[dice], stats.edgeGames[dice], stats.games, c))
+
+    def __nextValue__(self, stats, nextMask):
+        # Mean of a tile choice comes from the shared statistics of the board it leads to
+        nextStats = self.boards.get(nextMask)
+        if nextStats is not None and nextStats.games > 0:
+            return nextStats.average
+        return stats.edgeAverage[nextMask]
+
+    def __chooseNext__(self, stats, nextMasks, c):
+        for nextMask in nextMasks:
+            if stats.edgeGames.get(nextMask, 0) == 0:
+                return nextMask
+        return max(nextMasks, key = lambda nextMask: self.__explorationValue__(self.__nextValue__(stats, nextMask), stats.edgeGames[nextMask], stats.games, c))
+
+    def __rollout__(self, mask, rollouts, dice=None, roll=None):
+        if rollouts > 1:
+            if self.batchRollout is None:
+                self.batchRollout = BatchRollout(self.rules, random.getrandbits(64))
+            return float(self.batchRollout.rollouts(mask, rollouts, dice=dice, roll=roll).mean())
+        return simulateBoard(self.rules, mask, dice=dice, roll=roll)
+
+    def __simulateRound__(self, c, rollouts):
+        """
+        Descends the DAG from the current board, adds at most one new board or (board, roll) entry (while under
+        maxNodes) and expands one of its choices, finishes the game with a random rollout and backs the score
+        up along the visited path
+        """
+        mask = self.state.mask
+        dice = self.dice
+        path = []
+        while True:
+            if dice is None:
+                if mask == 0:
+                    score = 0
+                    break
+                stats = self.boards.get(mask)
+                expanded = stats is None
+                if expanded:
+                    if self.__full__():
+                        score = self.__rollout__(mask, rollouts)
+                        break
+                    stats = self.__addBoard__(mask)
+                dice = self.__chooseDice__(stats, mask, c)
+                path.append((stats, dice))
+                #A new board gets one dice choice expanded, then the game is finished randomly
+                if expanded:
+                    score = self.__rollout__(mask, rollouts, dice=dice)
+                    break
+            roll = 0
+            for i in range(dice):
+                roll = roll + random.randint(1, self.rules.faces)
+            nextMasks = self.table.legalNextMasks(mask, roll)
+            #If no valid combos, game is over
+            if len(nextMasks) == 0:
+                score = self.rules.maskScore[mask]
+                break
+            stats = self.rolls.get((mask, roll))
+            expanded = stats is None
+            if expanded:
+                if self.__full__():
+                    score = self.__rollout__(mask, rollouts, roll=roll)
+                    break
+                stats = RollStats()
+                self.rolls[(mask, roll)] = stats
+            mask = self.__chooseNext__(stats, nextMasks, c)
+            path.append((stats, mask))
+            #A new (board, roll) pair gets one tile choice expanded, then the game is finished randomly
+            if expanded:
+                score = self.__rollout__(mask, rollouts)
+                break
+            dice = None
+        games = rollouts if rollouts > 1 else 1
+        for stats, edge in path:
+            stats.update(edge, score, games)
+
+    def simulate(self, rounds, c, rollouts=1):
+        log.debug("Simulating %d rounds...", rounds)
+        if self.maxScore == 0:
+            return
+        start = time.perf_counter()
+        for i in range(rounds):
+            self.__simulateRound__(c, rollouts)
+        self.metrics.add("rounds", rounds)
+        self.metrics.add("simulateSeconds", time.perf_counter() - start)
+
+    def report(self):
+        """
+        Returns:
+            Metrics: Rounds and simulation time of every simulate call, with the number of table entries
+        """
+        metrics = Metrics()
+        metrics.merge(self.metrics)
+        metrics.peak("treeSize", self.treeSize())
+        return metrics
+
+    def rootGames(self):
+        return self.boards[self.state.mask].games if self.state.mask in self.boards else 0
+
+    def rollDecision(self):
+        if self.dice is not None:
+            log.warning("State is not prepared for a roll")
+        else:
+            mask = self.state.mask
+            stats = self.boards.get(mask)
+            options = self.__validDice__(mask)
+            if stats is not None:
+                options = [dice for dice in options if stats.edgeGames.get(dice, 0) > 0] or options
+                self.dice = min(options, key = lambda dice: stats.edgeAverage.get(dice, 0))
+            else:
+                self.dice = options[0]
+            return self.dice
+
+    def tileDecision(self, roll):
+        if self.dice is None:
+            log.warning("State is not prepared for a tile choice")
+        else:
+            self.dice = None
+            mask = self.state.mask
+            nextMasks = self.table.legalNextMasks(mask, roll)
+            if len(nextMasks) == 0:
+                return None
+            stats = self.rolls.get((mask, roll))
+            visited = [nextMask for nextMask in nextMasks if stats is not None and stats.edgeGames.get(nextMask, 0) > 0]
+            if len(visited) == 0:
+                choice = random.choice(nextMasks)
+            else:
+                choice = min(visited, key = lambda nextMask: self.__nextValue__(stats, nextMask))
+            self.state = Game.fromMask(self.state.players, self.table.numTiles, choice, self.rules)
+            if choice not in self.boards:
+                self.__addBoard__(choice)
+            return self.table.maskTiles[mask ^ choice]
+
+
+if __name__ == '__main__':
+    mc = TranspositionMonteCarlo(Game(2, 9), 2000)
+    c = 1
+    mc.simulate(200, c)
+    while(mc.state.getScore() > 0):
+        print("Score: {}\t Tiles:{}".format(mc.state.getScore(), mc.state.tiles))
+        mc.simulate(200, c)
+        diceUsed = mc.rollDecision()
+        roll = mc.state.rollDice(diceUsed)
+        tilesToShut = mc.tileDecision(roll)
+        print("Roll: {}\t Shutting: {}".format(roll, tilesToShut))
+        #Adjust c to less exploration and more exploitation as we get deeper
+        c = c/2
+        if tilesToShut == None:
+            break
+    print("Score: {}\t Tiles:{}".format(mc.state.getScore(), mc.state.tiles))
+    print("Table size: {} entries".format(mc.treeSize()))
@@ -0,0 +1,242 @@
+from game import getRules
+from rollout import BatchRollout
+from ShutTheBox_QLearning import decayingEpsilon
+from stats import RunningStats
+from metrics import Metrics
+from tablefile import saveQTable
+from statistics import mean, pstdev
+from multiprocessing import Lock, Pool
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import time
+
+WIN_REWARD = 100
+
+
+class DenseQTable:
+    """
+    Q-table of ShutTheBox_QLearning.qtable held in dense NumPy arrays:
+        qdice[mask, dice-1]                      value of rolling dice on a board
+        qcombo[mask, dice-1, roll, action]       value of shutting the action-th valid combo for a roll
+    Actions index the valid combos of a board and roll in move table order, and the next board of every
+    action comes from the precomputed table of the batch rollout engine. The game played is rules when
+    given and the standard game of numTiles tiles otherwise.
+    """
+    def __init__(self, numTiles=9, eta=0.2, gamma=0.9, seed=None, rules=None):
+        self.eta = eta
+        self.gamma = gamma
+        self.rules = rules if rules is not None else getRules(numTiles)
+        self.moves = BatchRollout(self.rules, seed)
+        self.rng = self.moves.rng
+        numMasks, numRolls, numActions = self.moves.nextMasks.shape
+        self.numDice = self.rules.numDice
+        self.legal = np.arange(numActions) < self.moves.comboCounts[:, :, None]
+        self.qdice = np.zeros((numMasks, self.numDice))
+        self.qcombo = np.zeros((numMasks, self.numDice, numRolls, numActions))
+        # preset final state to high values so it will be preferred during updates
+        self.qdice[0] = WIN_REWARD
+        self.qcombo[0] = WIN_REWARD
+        self.updates = 0
+        self.trainEpisodes = 0
+        self.trainSeconds = 0.0
+
+    def greedyDice(self, masks):
+        """
+        Index (dice-1) of the best dice count of every board, the most dice among equal values
+        """
+        return self.numDice-1 - self.qdice[masks, ::-1].argmax(axis=1)
+
+    def chooseDice(self, masks, epsilon):
+        greedy = self.greedyDice(masks) + 1
+        explore = self.rng.random(len(masks)) < epsilon
+        dice = np.where(explore, self.rng.integers(1, self.numDice+1, size=len(masks)), greedy)
+        dice[self.moves.allDice[masks]] = self.numDice
+        return dice
+
+    def chooseActions(self, masks, dice, rolls, counts, epsilon):
+        values = np.where(self.legal[masks, rolls], self.qcombo[masks, dice-1, rolls], -np.inf)
+        greedy = values.argmax(axis=1)
+        explore = self.rng.random(len(masks)) < epsilon
+        return np.where(explore, (self.rng.random(len(masks))*counts).astype(np.int64), greedy)
+
+    def update(self, masks, dice, rolls, actions, nextMasks, rewards):
+        """
+        Q-learning update of every (board, dice) and (board, dice, roll, action) pair of a step. When several games
+        update the same entry in one step, one of their updates is kept.
+        """
+        maxAction = self.greedyDice(nextMasks)
+        nextDice = self.qdice[nextMasks, maxAction]
+        nextCombo = self.qcombo[nextMasks, maxAction].reshape(len(nextMasks), -1).max(axis=1)
+        self.updates += len(masks)
+        d = dice - 1
+        self.qdice[masks, d] += self.eta*(rewards + self.gamma*nextDice - self.qdice[masks, d])
+        self.qcombo[masks, d, rolls, actions] += self.eta*(rewards + self.gamma*nextCombo - self.qcombo[masks, d, rolls, actions])
+
+    def playEpisodes(self, n, epsilon, learn=True):
+        """
+        Plays n episodes in lockstep from the full board
+
+        Returns:
+            ndarray: Total reward of every episode (tiles shut plus the win reward)
+        """
+        score = self.moves.score
+        masks = np.full(n, len(score)-1, dtype=np.int64)
+        rewardSums = np.zeros(n, dtype=np.int64)
+        active = np.arange(n)
+        while len(active) > 0:
+            dice = self.chooseDice(masks, epsilon)
+            rolls = self.moves.rollDice(dice)
+            counts = self.moves.comboCounts[masks, rolls]
+            # Episodes without a valid combo are over
+            moved = counts > 0
+            active, masks, dice, rolls, counts = active[moved], masks[moved], dice[moved], rolls[moved], counts[moved]
+            if len(active) == 0:
+                break
+            actions = self.chooseActions(masks, dice, rolls, counts, epsilon)
+            nextMasks = self.moves.nextMasks[masks, rolls, actions]
+            rewards = score[masks] - score[nextMasks] + WIN_REWARD*(nextMasks == 0)
+            rewardSums[active] += rewards
+            if learn:
+                self.update(masks, dice, rolls, actions, nextMasks, rewards)
+            playing = nextMasks != 0
+            active, masks = active[playing], nextMasks[playing]
+        return rewardSums
+
+    def train(self, episodes, batchSize=1000, eps_schedule=decayingEpsilon):
+        """
+        Trains over episodes, batchSize episodes at a time in lockstep. A batch uses the exploration rate
+        eps_schedule gives its first episode.
+
+        Returns:
+            ndarray: Total reward of every training episode
+        """
+        rewards = np.empty(episodes, dtype=np.int64)
+        clockStart = time.perf_counter()
+        for start in range(0, episodes, batchSize):
+            size = min(batchSize, episodes - start)
+            rewards[start:start+size] = self.playEpisodes(size, eps_schedule(start))
+        self.trainSeconds += time.perf_counter() - clockStart
+        self.trainEpisodes += episodes
+        return rewards
+
+    def report(self):
+        """
+        Returns:
+            Metrics: Training episodes, Q-value updates and the time spent in train
+        """
+        return Metrics({"trainEpisodes": self.trainEpisodes, "updates": self.updates, "trainSeconds": self.trainSeconds})
+
+    def evaluate(self, episodes):
+        """
+        Plays episodes greedily without learning
+
+        Returns:
+            ndarray: Total reward of every episode
+        """
+        return self.playEpisodes(episodes, 0, learn=False)
+
+
+def episodeStats(rewards, table):
+    """
+    RunningStats of an array of episode rewards
+    """
+    return RunningStats.fromArray(rewards, np.count_nonzero(rewards == table.moves.score[-1] + WIN_REWARD))
+
+
+# Lock guarding the shared Q-table of trainParallel, inherited by its worker processes
+mergeLock = None
+
+def initTrainWorker(lock):
+    global mergeLock
+    mergeLock = lock
+
+def trainWorker(worker, workers, episodes, syncEvery, batchSize, rules, eta, gamma, seed, eps_schedule, names):
+    """
+    Worker of trainParallel. Trains a local copy of the shared Q-table on its shard of episodes and every
+    syncEvery episodes adds its local changes since the last merge into the shared table, then reloads it.
+
+    Returns:
+        RunningStats: Statistics of the worker's training episodes
+    """
+    table = DenseQTable(eta=eta, gamma=gamma, seed=(seed, worker), rules=rules)
+    blocks = [SharedMemory(name=name) for name in names]
+    try:
+        shared = [np.ndarray(local.shape, dtype=local.dtype, buffer=block.buf) for local, block in zip((table.qdice, table.qcombo), blocks)]
+        with mergeLock:
+            np.copyto(table.qdice, shared[0])
+            np.copyto(table.qcombo, shared[1])
+        snapshots = [table.qdice.copy(), table.qcombo.copy()]
+        stats = RunningStats()
+        done = 0
+        sinceMerge = 0
+        while done < episodes:
+            size = min(batchSize, episodes - done)
+            # Exploration follows the overall progress of training over all workers
+            stats.merge(episodeStats(table.playEpisodes(size, eps_schedule(done*workers)), table))
+            done += size
+            sinceMerge += size
+            if sinceMerge >= syncEvery or done == episodes:
+                with mergeLock:
+                    for local, snapshot, sharedTable in zip((table.qdice, table.qcombo), snapshots, shared):
+                        sharedTable += local - snapshot
+                        np.copyto(local, sharedTable)
+                        np.copyto(snapshot, local)
+                sinceMerge = 0
+        return stats
+    finally:
+        for block in blocks:
+            block.close()
+
+def trainParallel(episodes, workers, syncEvery=1000, batchSize=100, numTiles=9, eta=0.2, gamma=0.9, seed=0, eps_schedule=decayingEpsilon,
+                  rules=None):
+    """
+    Trains a DenseQTable over episodes split across worker processes. Each worker runs its shard of episodes
+    against a local copy of the table and periodically merges its updates into a table held in shared memory.
+    Worker i draws its random numbers from the seed (seed, i).
+
+    Returns:
+        tuple: The trained DenseQTable and the RunningStats of all training episodes
+    """
+    table = DenseQTable(numTiles, eta, gamma, seed=seed, rules=rules)
+    blocks = [SharedMemory(create=True, size=array.nbytes) for array in (table.qdice, table.qcombo)]
+    try:
+        shared = [np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf) for array, block in zip((table.qdice, table.qcombo), blocks)]
+        np.copyto(shared[0], table.qdice)
+        np.copyto(shared[1], table.qcombo)
+        names = [block.name for block in blocks]
+        tasks = []
+        for worker in range(workers):
+            shard = episodes//workers + (1 if worker < episodes % workers else 0)
+            tasks.append((worker, workers, shard, syncEvery, batchSize, table.rules, eta, gamma, seed, eps_schedule, names))
+        with Pool(workers, initializer=initTrainWorker, initargs=(Lock(),)) as pool:
+            results = pool.starmap(trainWorker, tasks)
+        np.copyto(table.qdice, shared[0])
+        np.copyto(table.qcombo, shared[1])
+        del shared
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    stats = RunningStats()
+    for workerStats in results:
+        stats.merge(workerStats)
+    return table, stats
+
+
+def report(name, rewards, table):
+    # Only a won game collects every tile and the win reward
+    wins = int(np.count_nonzero(rewards == table.moves.score[-1] + WIN_REWARD))
+    print("{}-Average: {}".format(name, mean(rewards.tolist())))
+    print("{}-Standard-Deviation: {}".format(name, pstdev(rewards.tolist())))
+    print("{}-Wins: {} out of {} games".format(name, wins, len(rewards)))
+    print("{}-Win-Percentage: {}".format(name, wins/len(rewards)*100))
+
+
+if __name__ == "__main__":
+    table = DenseQTable()
+    start = time.perf_counter()
+    trainingRewards = table.train(100000)
+    print("Trained 100,000 episodes in {:.2f} seconds".format(time.perf_counter() - start))
+    report("Training", trainingRewards, table)
+    report("Test", table.evaluate(10000), table)
+    saveQTable("DenseQTable.bin", table.qdice, table.qcombo, table.moves.numTiles, table.eta, table.gamma, 100000, table.rules)
@@ -0,0 +1,165 @@
+from game import tilesToMask
+from stats import RunningStats
+import os
+import numpy as np
+
+# File layout: MAGIC followed by packed RECORD entries, one per game, appended as games finish.
+MAGIC = b"STBRSLT2"
+RECORD = np.dtype([
+    ("score", "<i8"),       # Score of the tiles left open under the rules of the game
+    ("mask", "<u2"),        # Tile mask of the final board
+    ("algorithm", "u1"),    # Index into ALGORITHMS
+    ("seed", "<i8"),        # Seed the game was played with, -1 when unseeded
+    ("seconds", "<f4"),     # Wall-clock time of the game
+])
+# Record layout of every file version, so older files are still read and appended to. Version 1 stored the
+# score as int16, too narrow for digit scoring.
+LAYOUTS = {
+    b"STBRSLT1": np.dtype([("score", "<i2"), ("mask", "<u2"), ("algorithm", "u1"), ("seed", "<i8"), ("seconds", "<f4")]),
+    MAGIC: RECORD,
+}
+# Append only, so existing files keep their meaning
+ALGORITHMS = ["mcts", "minimax", "exact", "table", "qlearn-train", "qlearn-test"]
+UNSEEDED = -1
+
+
+def fileLayout(path):
+    """
+    Returns the record dtype of a results file
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+    if magic not in LAYOUTS:
+        raise ValueError("{} is not a results file".format(path))
+    return LAYOUTS[magic]
+
+
+def packResults(results):
+    """
+    Packs [score, tiles, seed, seconds] game results into a RECORD array, with the algorithm left for
+    ResultWriter.writeRecords to fill in
+    """
+    records = np.zeros(len(results), dtype=RECORD)
+    for i, (score, tiles, seed, seconds) in enumerate(results):
+        records[i] = (score, tilesToMask(tiles), 0, seed, seconds)
+    return records
+
+
+class ResultWriter:
+    """
+    Appends game results to a results file, buffering bufferSize records between writes, and keeps
+    RunningStats of the final scores written through it (a win is a score of 0)
+    """
+    def __init__(self, path, algorithm, bufferSize=4096):
+        self.path = path
+        self.algorithm = ALGORITHMS.index(algorithm)
+        self.pending = 0
+        self.stats = RunningStats()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+            self.file.flush()
+        # Appends keep the layout of an existing file
+        try:
+            self.layout = fileLayout(path)
+        except ValueError:
+            self.file.close()
+            raise
+        self.buffer = np.zeros(bufferSize, dtype=self.layout)
+
+    def write(self, score, tiles, seed=UNSEEDED, seconds=0.0):
+        """
+        Records one game
+
+        Parameters:
+            score (int): Final score
+            tiles (list): Tiles left open
+            seed (int): Seed of the game
+            seconds (float): Time taken to play the game
+        """
+        self.stats.add(score, score == 0)
+        self.buffer[self.pending] = (score, tilesToMask(tiles), self.algorithm, seed, seconds)
+        self.pending += 1
+        if self.pending == len(self.buffer):
+            self.flush()
+
+    def writeRecords(self, records):
+        """
+        Records a packed RECORD array of games, such as one made by packResults, as games of this
+        writer's algorithm
+        """
+        records = records.astype(self.layout)
+        records["algorithm"] = self.algorithm
+        scores = records["score"].astype(np.int64)
+        self.stats.merge(RunningStats.fromArray(scores, np.count_nonzero(scores == 0)))
+        self.flush()
+        self.file.write(records.tobytes())
+        self.file.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.pending].tobytes())
+        self.file.flush()
+        self.pending = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResultReader:
+    """
+    Reads a results file through a read-only memory map, chunkSize records at a time
+    """
+    def __init__(self, path, chunkSize=1 << 20):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.layout = fileLayout(path)
+        # A trailing partial record of an interrupted write is ignored
+        self.count = (os.path.getsize(path) - len(MAGIC))//self.layout.itemsize
+
+    def __len__(self):
+        return self.count
+
+    def chunks(self):
+        if self.count == 0:
+            return
+        records = np.memmap(self.path, dtype=self.layout, mode="r", offset=len(MAGIC), shape=(self.count,))
+        for start in range(0, self.count, self.chunkSize):
+            yield records[start:start+self.chunkSize]
+
+    def summary(self):
+        """
+        Aggregates the file chunk by chunk
+
+        Returns:
+            dict: Algorithm name to (RunningStats of the scores, total seconds)
+        """
+        summary = {}
+        for chunk in self.chunks():
+            for code in np.unique(chunk["algorithm"]):
+                selected = chunk[chunk["algorithm"] == code]
+                scores = selected["score"].astype(np.int64)
+                stats, seconds = summary.get(ALGORITHMS[code], (RunningStats(), 0.0))
+                stats.merge(RunningStats.fromArray(scores, np.count_nonzero(scores == 0)))
+                summary[ALGORITHMS[code]] = (stats, seconds + float(selected["seconds"].sum(dtype=np.float64)))
+        return summary
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Summarize a results file without loading it into memory",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("path", help="Results file")
+    args = parser.parse_args()
+    reader = ResultReader(args.path)
+    print("{} games".format(len(reader)))
+    for algorithm, (stats, seconds) in reader.summary().items():
+        print("{}: {} games in {:.2f} seconds\t{}".format(algorithm, stats.count, seconds, stats))
@@ -0,0 +1,96 @@
+import numpy as np
+
+class BatchRollout:
+    """
+    Vectorized random rollout engine. Plays many random games from the same board at once, with the
+    boards held as a NumPy array of tile masks, and returns their final scores.
+
+    The rollout policy matches MonteCarlo.__simulateRound__: roll every die while a tile above the rules'
+    one-die threshold is open and a random number of dice otherwise, then shut a uniformly random valid combo.
+    """
+    def __init__(self, rules, seed=None):
+        table = rules.table
+        numMasks = table.fullMask + 1
+        maxRoll = rules.maxRoll
+        counts = np.zeros((numMasks, maxRoll+1), dtype=np.int32)
+        for mask in range(numMasks):
+            for roll in range(min(maxRoll, table.maxRoll)+1):
+                counts[mask, roll] = len(table.nextMasks[mask][roll])
+        # Next boards padded to the largest number of combos for any board and roll
+        nextMasks = np.zeros((numMasks, maxRoll+1, max(1, counts.max())), dtype=np.int32)
+        for mask in range(numMasks):
+            for roll in range(min(maxRoll, table.maxRoll)+1):
+                valid = table.nextMasks[mask][roll]
+                nextMasks[mask, roll, :len(valid)] = valid
+        self.rules = rules
+        self.numTiles = rules.numTiles
+        self.numDice = rules.numDice
+        self.faces = rules.faces
+        self.comboCounts = counts
+        self.nextMasks = nextMasks
+        self.score = np.array(rules.maskScore, dtype=np.int64)
+        self.maxTile = np.array(table.maskMaxTile, dtype=np.int64)
+        # Boards on which every die has to be rolled
+        self.allDice = np.array([len(options) == 1 for options in rules.maskDice])
+        self.rng = np.random.default_rng(seed)
+
+    def rollDice(self, dice):
+        """
+        Returns the sum of rolling dice[i] dice for every i
+        """
+        faces = self.rng.integers(1, self.faces+1, size=(len(dice), self.numDice))
+        faces[np.arange(self.numDice) >= dice[:, None]] = 0
+        return faces.sum(axis=1)
+
+    def chooseDice(self, masks):
+        dice = self.rng.integers(1, self.numDice+1, size=len(masks))
+        dice[self.allDice[masks]] = self.numDice
+        return dice
+
+    def shutRandom(self, masks, rolls):
+        """
+        Shuts a random valid combo on every board. Returns the next boards and whether each board had a move.
+        """
+        counts = self.comboCounts[masks, rolls]
+        moved = counts > 0
+        choice = (self.rng.random(len(masks))*counts).astype(np.int64)
+        return np.where(moved, self.nextMasks[masks, rolls, choice], masks), moved
+
+    def rollouts(self, mask, k, dice=None, roll=None):
+        """
+        Plays k random games from a board
+
+        Parameters:
+            mask (int): Tile mask of the starting board
+            k (int): Number of games to play
+            dice (int): If given, the games start with this many dice already chosen
+            roll (int): If given, the games start with this roll already thrown
+
+        Returns:
+            ndarray: Final score of each game
+        """
+        masks = np.full(k, mask, dtype=np.int64)
+        scores = np.empty(k, dtype=np.int64)
+        active = np.arange(k)
+        if roll is not None or dice is not None:
+            if roll is not None:
+                rolls = np.full(k, roll, dtype=np.int64)
+            else:
+                rolls = self.rollDice(np.full(k, dice, dtype=np.int64))
+            masks, moved = self.shutRandom(masks, rolls)
+            scores[~moved] = self.score[masks[~moved]]
+            active = active[moved]
+            masks = masks[moved]
+        while len(active) > 0:
+            # Games with every tile shut are over with the optimal score of 0
+            playing = self.score[masks] > 0
+            scores[active[~playing]] = 0
+            active = active[playing]
+            masks = masks[playing]
+            rolls = self.rollDice(self.chooseDice(masks))
+            masks, moved = self.shutRandom(masks, rolls)
+            # Games without a valid combo are over with the score of the board
+            scores[active[~moved]] = self.score[masks[~moved]]
+            active = active[moved]
+            masks = masks[moved]
+        return scores
@@ -0,0 +1,95 @@
+from game import Game, getRules, expectedValue
+
+class Solution:
+    """
+    Exact solution of a variant of the game (see game.Rules): the optimal expected final score of every
+    board together with the dice and tile choices that achieve it. Boards are indexed by their bitmask.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.table = rules.table
+        numMasks = self.table.fullMask + 1
+        maxRoll = rules.maxRoll
+        self.maxRoll = maxRoll
+        self.values = [0.0]*numMasks
+        self.diceChoice = [None]*numMasks
+        self.tileChoice = [[None]*(maxRoll+1) for _ in range(numMasks)]
+        self.__solve__()
+
+    def __solve__(self):
+        """
+        Fills the tables bottom-up. Shutting tiles only ever clears bits, so every successor of a board
+        has a smaller mask and is already solved when the board is reached in increasing order.
+        """
+        rules = self.rules
+        table = self.table
+        values = self.values
+        for mask in range(1, table.fullMask+1):
+            score = rules.maskScore[mask]
+            combos = table.combos[mask]
+            nextMasks = table.nextMasks[mask]
+            tileChoice = self.tileChoice[mask]
+            # Value of the board after each roll, when the best tiles are shut
+            rollValues = [score]*(self.maxRoll+1)
+            for roll in range(1, min(self.maxRoll, table.maxRoll)+1):
+                best = None
+                for combo, nextMask in zip(combos[roll], nextMasks[roll]):
+                    if best is None or values[nextMask] < rollValues[roll]:
+                        best = combo
+                        rollValues[roll] = values[nextMask]
+                tileChoice[roll] = best
+            for diceRolled in rules.maskDice[mask]:
+                value = expectedValue(rules.distributions[diceRolled], rollValues)
+                if self.diceChoice[mask] is None or value < values[mask]:
+                    self.diceChoice[mask] = diceRolled
+                    values[mask] = value
+
+_solutions = {}
+
+def getSolution(rules):
+    """
+    Returns the Solution of rules, solving it on first use
+    """
+    solution = _solutions.get(rules.key())
+    if solution is None:
+        solution = Solution(rules)
+        _solutions[rules.key()] = solution
+    return solution
+
+class ExactSolver:
+    """
+    Optimal policy with the same rollDecision/tileDecision interface as Minimax, answered by table lookup
+    """
+    def __init__(self, players, numTiles=9, rules=None):
+        self.players = players
+        self.solution = getSolution(rules if rules is not None else getRules(numTiles))
+
+    def rollDecision(self, boxState):
+        return self.solution.diceChoice[boxState.mask]
+
+    def tileDecision(self, roll, boxState):
+        if roll < 0 or roll > self.solution.maxRoll:
+            return None
+        combo = self.solution.tileChoice[boxState.mask][roll]
+        if combo is None:
+            return None
+        return self.solution.table.maskTiles[combo]
+
+    def expectedScore(self, boxState):
+        return self.solution.values[boxState.mask]
+
+if __name__ == '__main__':
+    game = Game(2, 9)
+    solver = ExactSolver(2, 9)
+    print("Expected final score: {}".format(solver.expectedScore(game)))
+    while(game.getScore() > 0):
+        print("Score: {}\t Tiles:{}".format(game.getScore(), game.tiles))
+        diceUsed = solver.rollDecision(game)
+        roll = game.rollDice(diceUsed)
+        tilesToShut = solver.tileDecision(roll, game)
+        print("Roll: {}\t Shutting: {}".format(roll, tilesToShut))
+        if tilesToShut != None:
+            game.playCombo(tilesToShut)
+        else:
+            break
+    print("Final score: {}".format(game.getScore()))
@@ -0,0 +1,114 @@
+import math
+
+
+class RunningStats(object):
+    """
+    Streaming accumulator of the mean, population standard deviation and win rate of game results,
+    using Welford's algorithm so memory stays constant in the number of games
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.wins = 0
+        self.last = None
+
+    def add(self, value, won=False):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(value - self.mean)
+        if won:
+            self.wins += 1
+        self.last = value
+
+    @classmethod
+    def fromArray(cls, values, wins=0):
+        """
+        RunningStats of a NumPy array of values, computed in bulk
+        """
+        stats = cls()
+        if len(values) > 0:
+            stats.count = len(values)
+            stats.mean = float(values.mean())
+            stats.m2 = float(((values - stats.mean)**2).sum())
+            stats.wins = int(wins)
+            stats.last = values[-1].item()
+        return stats
+
+    def merge(self, other):
+        """
+        Adds the results accumulated by another RunningStats
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta*delta*self.count*other.count/count
+        self.mean += delta*other.count/count
+        self.count = count
+        self.wins += other.wins
+        self.last = other.last
+
+    @property
+    def variance(self):
+        return self.m2/self.count if self.count else 0.0
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def winRate(self):
+        return self.wins/self.count if self.count else 0.0
+
+    def meanInterval(self, z=1.96):
+        """
+        Normal-approximation confidence interval of the mean (95% for z=1.96)
+        """
+        half = z*math.sqrt(self.variance/self.count) if self.count else 0.0
+        return (self.mean - half, self.mean + half)
+
+    def winRateInterval(self, z=1.96):
+        """
+        Wilson score confidence interval of the win rate, which stays inside [0, 1] for rare wins
+        """
+        if self.count == 0:
+            return (0.0, 0.0)
+        n = self.count
+        p = self.winRate
+        center = (p + z*z/(2*n))/(1 + z*z/n)
+        half = z*math.sqrt(p*(1 - p)/n + z*z/(4*n*n))/(1 + z*z/n)
+        return (max(0.0, center - half), min(1.0, center + half))
+
+    def __str__(self):
+        return "Av: {}\tStdDv: {} Win%: {}".format(self.mean, self.stddev, self.winRate)
+
+
+class ScoreDistribution(object):
+    """
+    Exact distribution of the final score of a game, as the probability of every score
+    """
+    def __init__(self, probabilities):
+        # Score to probability, in increasing score order
+        self.histogram = dict(sorted(probabilities.items()))
+
+    @property
+    def mean(self):
+        return sum(score*probability for score, probability in self.histogram.items())
+
+    @property
+    def variance(self):
+        mean = self.mean
+        return sum((score - mean)**2*probability for score, probability in self.histogram.items())
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def winRate(self):
+        return self.histogram.get(0, 0.0)
+
+    def __str__(self):
+        return "Av: {}\tStdDv: {} Win%: {}".format(self.mean, self.stddev, self.winRate)
@@ -0,0 +1,227 @@
+from game import Game, getRules, rulesFromDict, tilesToMask
+from solver import getSolution
+import json
+import struct
+import numpy as np
+
+# File layout:
+#   MAGIC, header length (little-endian uint64), JSON header, arrays
+# The header records the table kind, tiles, rules, eta, gamma, episodes and the dtype, shape and offset of
+# every array. Arrays are stored raw in C order, each starting on an ALIGN-byte boundary, so a reader maps the
+# file once and views every array in place.
+MAGIC = b"STBTABLE"
+VERSION = 1
+ALIGN = 64
+
+QTABLE = "qtable"
+POLICY = "policy"
+BOOK = "book"
+
+
+def alignOffset(offset):
+    return (offset + ALIGN - 1)//ALIGN*ALIGN
+
+def writeTables(path, header, arrays):
+    """
+    Writes arrays to path behind a header
+
+    Parameters:
+        path (str): File to write
+        header (dict): JSON serializable metadata of the tables
+        arrays (dict): Name to ndarray of every table
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    entries = []
+    offset = 0
+    for name, array in arrays.items():
+        entries.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset = alignOffset(offset + array.nbytes)
+    meta = json.dumps(dict(header, version=VERSION, arrays=entries)).encode()
+    dataStart = alignOffset(len(MAGIC) + 8 + len(meta))
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(meta)))
+        f.write(meta)
+        for entry, array in zip(entries, arrays.values()):
+            f.write(bytes(dataStart + entry["offset"] - f.tell()))
+            f.write(array.tobytes())
+
+def readTables(path):
+    """
+    Maps a file written by writeTables read-only. The arrays are views of the mapping, so nothing is copied
+    and processes mapping the same file share its pages.
+
+    Returns:
+        tuple: The header dict and a dict of name to read-only ndarray
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a table file".format(path))
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    if header.get("version") != VERSION:
+        raise ValueError("{} has unsupported table file version {}".format(path, header.get("version")))
+    dataStart = alignOffset(len(MAGIC) + 8 + length)
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        start = dataStart + entry["offset"]
+        arrays[entry["name"]] = data[start:start + count*dtype.itemsize].view(dtype).reshape(entry["shape"])
+    return header, arrays
+
+
+def qtableArrays(table):
+    """
+    Dense copies of a ShutTheBox_QLearning.qtable, laid out as DenseQTable.qdice and DenseQTable.qcombo:
+    actions index the valid combos of a board and roll in move table order. States the table never created
+    keep their initial value of 0.
+    """
+    rules = table.rules
+    moves = rules.table
+    numMasks = moves.fullMask + 1
+    maxRoll = rules.maxRoll
+    numActions = max(len(moves.legalCombos(mask, roll)) for mask in range(numMasks) for roll in range(maxRoll+1))
+    qdice = np.zeros((numMasks, rules.numDice))
+    qcombo = np.zeros((numMasks, rules.numDice, maxRoll+1, numActions))
+    for mask in range(numMasks):
+        entry = table.rollTable.get(tuple(moves.maskTiles[mask]))
+        if entry is None:
+            continue
+        for d, diceEntry in enumerate(entry):
+            qdice[mask, d] = diceEntry.qvalue
+            for roll, values in diceEntry.rolls.items():
+                for action, combo in enumerate(moves.legalCombos(mask, roll)):
+                    qcombo[mask, d, roll, action] = values[moves.maskTiles[combo]]
+    if () in table.rollTable:
+        # The final state has no combos, its preset best value fills every action as in DenseQTable
+        qcombo[0] = table.rollTable[()][0].bestRoll[0]
+    return qdice, qcombo
+
+def saveQTable(path, qdice, qcombo, numTiles=9, eta=0.2, gamma=0.9, episodes=0, rules=None):
+    """
+    Writes Q-values in the DenseQTable layout (see qtableArrays) of the game rules (by default the standard
+    game of numTiles tiles). They stay float64 so values tie exactly where they do in the trained table.
+    """
+    rules = rules if rules is not None else getRules(numTiles)
+    header = {"kind": QTABLE, "tiles": rules.numTiles, "rules": rules.asDict(), "eta": eta, "gamma": gamma, "episodes": episodes}
+    writeTables(path, header, {"qdice": qdice.astype(np.float64), "qcombo": qcombo.astype(np.float64)})
+
+def policyArrays(policy, rules):
+    """
+    Tabulates a policy with the rollDecision/tileDecision interface of Minimax over every board and roll
+    of a game's rules
+
+    Returns:
+        tuple: dice[mask] to roll (0 for the empty board) and tiles[mask, roll] mask of the combo to shut
+               (0 when no combo can be shut)
+    """
+    moves = rules.table
+    numMasks = moves.fullMask + 1
+    maxRoll = rules.maxRoll
+    dice = np.zeros(numMasks, dtype=np.int8)
+    tiles = np.zeros((numMasks, maxRoll+1), dtype=np.uint16)
+    for mask in range(1, numMasks):
+        dice[mask] = policy.rollDecision(Game.fromMask(2, rules.numTiles, mask, rules))
+        for roll in range(1, maxRoll+1):
+            if len(moves.legalCombos(mask, roll)) > 0:
+                tiles[mask, roll] = tilesToMask(policy.tileDecision(roll, Game.fromMask(2, rules.numTiles, mask, rules)))
+    return dice, tiles
+
+def savePolicy(path, dice, tiles, rules, source="", values=None):
+    """
+    Writes a policy table from policyArrays, with the expected score of every board when known
+    """
+    header = {"kind": POLICY, "tiles": rules.numTiles, "rules": rules.asDict(), "eta": None, "gamma": None, "episodes": 0,
+              "source": source}
+    arrays = {"dice": dice, "tiles": tiles}
+    if values is not None:
+        arrays["values"] = np.asarray(values, dtype=np.float64)
+    writeTables(path, header, arrays)
+
+def exactPolicyArrays(rules):
+    """
+    The exact solution of rules in the policyArrays layout
+
+    Returns:
+        tuple: dice[mask], tiles[mask, roll] and the optimal expected score values[mask]
+    """
+    solution = getSolution(rules)
+    dice = np.array([dice or 0 for dice in solution.diceChoice], dtype=np.int8)
+    tiles = np.array([[combo or 0 for combo in rolls] for rolls in solution.tileChoice], dtype=np.uint16)
+    return dice, tiles, np.array(solution.values)
+
+def saveExactPolicy(path, rules):
+    dice, tiles, values = exactPolicyArrays(rules)
+    savePolicy(path, dice, tiles, rules, "exact", values)
+
+
+class TablePolicy:
+    """
+    Policy answered from a memory-mapped table file, with the same rollDecision/tileDecision interface as
+    Minimax. Policy tables are looked up directly and Q-tables are followed greedily.
+    """
+    def __init__(self, path):
+        self.header, self.arrays = readTables(path)
+        self.kind = self.header["kind"]
+        # Files written before rules were recorded hold the standard game of their tiles
+        self.rules = rulesFromDict(self.header.get("rules", {"tiles": self.header["tiles"]}))
+        self.table = self.rules.table
+
+    def rollDecision(self, boxState):
+        mask = boxState.mask
+        if self.kind == POLICY:
+            return int(self.arrays["dice"][mask])
+        options = self.rules.maskDice[mask]
+        if len(options) == 1:
+            return options[0]
+        # Most dice among equal values, as in qtable.bestDice
+        qdice = self.arrays["qdice"][mask]
+        return len(qdice) - int(qdice[::-1].argmax())
+
+    def tileDecision(self, roll, boxState):
+        mask = boxState.mask
+        combos = self.table.legalCombos(mask, roll)
+        if len(combos) == 0:
+            return None
+        if self.kind == POLICY:
+            return self.table.maskTiles[int(self.arrays["tiles"][mask, roll])]
+        # Greedy combo of the die count the table prefers, the last of equal values in combo order. The
+        # in-memory qtable.greedyCombo breaks ties by which combo reached the value last, which the file does
+        # not record, so the two can pick different combos among equal values
+        values = self.arrays["qcombo"][mask, self.rollDecision(boxState)-1, roll]
+        best = 0
+        for action in range(len(combos)):
+            if values[action] >= values[best]:
+                best = action
+        return self.table.maskTiles[combos[best]]
+
+    def expectedScore(self, boxState):
+        if "values" not in self.arrays:
+            return None
+        return float(self.arrays["values"][boxState.mask])
+
+
+if __name__ == '__main__':
+    import argparse
+    from game import addRulesArguments, rulesFromArguments
+    from minimax import Minimax, TranspositionCache
+    parser = argparse.ArgumentParser(
+        description="Save a solved policy table, or print the header of a table file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("command", choices=["exact", "minimax", "info"], help="Policy to save, or info to read path")
+    parser.add_argument("path", help="Table file")
+    addRulesArguments(parser)
+    parser.add_argument("--depth", type=int, default=3, help="maxDepth of the minimax policy")
+    args = parser.parse_args()
+    rules = rulesFromArguments(args)
+    if "exact" == args.command:
+        saveExactPolicy(args.path, rules)
+    elif "minimax" == args.command:
+        dice, tiles = policyArrays(Minimax(2, args.depth, TranspositionCache()), rules)
+        savePolicy(args.path, dice, tiles, rules, "minimax depth {}".format(args.depth))
+    header, arrays = readTables(args.path)
+    print({key: value for key, value in header.items() if key != "arrays"})
+    for name, array in arrays.items():
+        print("{}: {} {}".format(name, array.dtype, array.shape))